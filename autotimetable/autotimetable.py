@@ -1,13 +1,24 @@
 import asyncio
 import contextlib
 import datetime
+import hashlib
 import json
+import logging
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from operator import attrgetter, itemgetter
 
-import aiohttp
 import discord
 import pytz
-from redbot.core import commands
+from redbot.core import Config, commands
 from redbot.core.data_manager import bundled_data_path, cog_data_path
+from redbot.core.utils.chat_formatting import box, pagify
+
+from .http import HTTPClient
+
+log = logging.getLogger("red.flare.autotimetable")
 
 ReqHeaders = {
     "Authorization": "basic T64Mdy7m[",
@@ -17,98 +28,803 @@ ReqHeaders = {
     "Origin": "https://opentimetable.dcu.ie/",
 }
 
-COURSES = {
+# Course -> [channel, message] bindings from before they were stored in Config.
+# Only used to seed the bindings on first load.
+LEGACY_COURSES = {
     "COMSCI1": [894237845802344478, 894239236352507976],
     "CASE2": [889594375598923857, 894239188931706972],
     "CASE3": [889591587213045810, 894239169407246428],
     "CASE4": [889594398613069874, 894239034304507914],
 }
 
-GUILD = 713522800081764392
-# GUILD = 397040193720287243
+LEGACY_GUILD = 713522800081764392
+
+IDENTITY_PLACEHOLDER = json.dumps("__CATEGORY_IDENTITY__")
+
+
+class Event:
+    """A single timetable event with its times decoded to epoch seconds."""
+
+    __slots__ = ("start", "end", "name", "location")
+
+    def __init__(self, start, end, name, location):
+        self.start = start
+        self.end = end
+        self.name = name
+        self.location = location
 
-# COURSES = {
-#     "CASE4": [693451350775955518, 898944947938529320]
-# }
+
+class EventIndex:
+    """A course's events sorted by start time for binary-search day lookups."""
+
+    __slots__ = ("starts", "events")
+
+    def __init__(self, days):
+        self.events = sorted(
+            (
+                Event(
+                    int(datetime.datetime.fromisoformat(start).timestamp()),
+                    int(datetime.datetime.fromisoformat(end).timestamp()),
+                    name,
+                    location,
+                )
+                for entries in days.values()
+                for start, end, name, location in entries
+            ),
+            key=attrgetter("start"),
+        )
+        self.starts = array("q", (event.start for event in self.events))
+
+    def between(self, lo, hi):
+        """Return the events starting in ``[lo, hi)``."""
+        return self.events[bisect_left(self.starts, lo) : bisect_left(self.starts, hi)]
 
 
 class AutoTimetable(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
+        self.http = HTTPClient(base_url="https://opentimetable.dcu.ie")
+        self.config = Config.get_conf(self, identifier=95932766180343808, force_registration=True)
+        self.config.register_global(
+            concurrency=4,
+            identity_ttl=30 * 24 * 60 * 60,
+            unknown_ttl=24 * 60 * 60,
+            snapshot_ttl=7 * 24 * 60 * 60,
+            refresh_interval=6 * 60 * 60,
+            embed_hashes={},
+            publish_time="20:00",
+            schedules={},
+            prefetch=10 * 60,
+            last_published={},
+            bindings={},
+            schema_version=0,
+        )
+        self.identities_path = cog_data_path(self) / "identities.json"
+        self.identities = self.load_identities()
+        self.snapshots_path = cog_data_path(self) / "snapshots"
+        self.snapshots_path.mkdir(exist_ok=True)
+        self.snapshots = self.load_snapshots()
+        self.events = {course: EventIndex(snapshot["days"]) for course, snapshot in self.snapshots.items()}
+        self.snapshot_locks = defaultdict(asyncio.Lock)
         self.req_data = self.get_req_data()
+        self.weeks = self.build_weeks(self.req_data["ViewOptions"]["DateConfig"])
+        first_week = datetime.date.fromisoformat(self.weeks[0]["FirstDayInWeek"][:10])
+        self.year = (first_week, first_week + datetime.timedelta(days=7 * len(self.weeks) - 1))
+        self.templates = {}
+        self.timings = {}
+        self.edit_stats = Counter()
+        self.lags = defaultdict(lambda: deque(maxlen=30))
         self.loop = asyncio.ensure_future(self.initialise())
+        self.refresh_loop = asyncio.ensure_future(self.refresh_snapshots_loop())
 
     def get_req_data(self):
         with open(bundled_data_path(self) / "request.json") as f:
             return json.load(f)
 
+    def load_identities(self):
+        try:
+            with open(self.identities_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_identities(self):
+        with open(self.identities_path, "w") as f:
+            json.dump(self.identities, f)
+
+    async def get_identity(self, course, *, refresh=False):
+        """Resolve a course code to its category identity, using the on-disk cache when fresh.
+
+        Courses opentimetable doesn't know are cached as None for ``unknown_ttl``."""
+        cached = self.identities.get(course)
+        if not refresh and cached is not None:
+            if cached["identity"] is None:
+                ttl = await self.config.unknown_ttl()
+            else:
+                ttl = await self.config.identity_ttl()
+            if time.time() - cached["fetched"] < ttl:
+                return cached["identity"]
+        resp = await self.http.request_json(
+            "POST",
+            f"/broker/api/CategoryTypes/241e4d36-60e0-49f8-b27e-99416745d98d/Categories/Filter?pageNumber=1&query={course}",
+            endpoint="opentimetable categories",
+            headers=ReqHeaders,
+        )
+        if resp.data is None:
+            return None
+        now = time.time()
+        if resp.data["Results"]:
+            identity = resp.data["Results"][0]["Identity"]
+        else:
+            identity = None
+            # Drop expired unknowns so made-up course codes don't pile up on disk.
+            unknown_ttl = await self.config.unknown_ttl()
+            self.identities = {
+                key: entry
+                for key, entry in self.identities.items()
+                if entry["identity"] is not None or now - entry["fetched"] < unknown_ttl
+            }
+        self.identities[course] = {"identity": identity, "fetched": now}
+        self.save_identities()
+        return identity
+
+    def load_snapshots(self):
+        snapshots = {}
+        for path in self.snapshots_path.glob("*.json"):
+            try:
+                with open(path) as f:
+                    snapshots[path.stem] = json.load(f)
+            except json.JSONDecodeError:
+                continue
+        return snapshots
+
+    def save_snapshot(self, course):
+        with open(self.snapshots_path / f"{course}.json", "w") as f:
+            json.dump(self.snapshots[course], f, separators=(",", ":"))
+
+    @staticmethod
+    def build_weeks(date_config):
+        """Derive the academic week table from the bundled ``DateConfig``."""
+        start = datetime.datetime.fromisoformat(date_config["StartDate"]).date()
+        end = datetime.datetime.fromisoformat(date_config["EndDate"]).date()
+        weeks = []
+        while start <= end:
+            weeks.append(
+                {
+                    "WeekNumber": len(weeks) + 1,
+                    "WeekLabel": str(len(weeks) + 1),
+                    "FirstDayInWeek": start.strftime("%Y-%m-%dT00:00:00.000Z"),
+                }
+            )
+            start += datetime.timedelta(days=7)
+        return weeks
+
+    def weeks_between(self, first, last):
+        """Return the week entries overlapping ``first`` to ``last``."""
+        lo = max((first - self.year[0]).days // 7, 0)
+        hi = min((last - self.year[0]).days // 7, len(self.weeks) - 1)
+        return self.weeks[lo : hi + 1]
+
+    def build_payload(self, identity, first, last=None):
+        """Build an events request covering ``first`` to ``last`` (inclusive) for one category."""
+        last = last or first
+        view = self.req_data["ViewOptions"]
+        if first == last:
+            day_of_week = first.isoweekday() % 7
+            days = [{**d, "IsDefault": True} for d in view["AllDays"] if d["DayOfWeek"] == day_of_week]
+            description = first.strftime("%A")
+        else:
+            days = view["Days"]
+            description = f"{first} - {last}"
+        period = {
+            **view["DatePeriods"][0],
+            "Description": description,
+            "StartDateTime": first.strftime("%Y-%m-%dT00:00:00.000Z"),
+            "EndDateTime": (last + datetime.timedelta(days=1)).strftime("%Y-%m-%dT00:00:00.000Z"),
+        }
+        return {
+            **self.req_data,
+            "ViewOptions": {
+                **view,
+                "Days": days,
+                "Weeks": self.weeks_between(first, last),
+                "DatePeriods": [period],
+            },
+            "CategoryIdentities": [identity],
+        }
+
+    def payload_template(self, first, last=None):
+        """Return the pre-serialised payload for a date range split around the identity.
+
+        Templates are immutable tuples so concurrent runs can share them safely."""
+        key = (first, last or first)
+        template = self.templates.get(key)
+        if template is None:
+            if len(self.templates) >= 7:
+                self.templates.clear()
+            body = json.dumps(self.build_payload(json.loads(IDENTITY_PLACEHOLDER), *key))
+            template = self.templates[key] = tuple(body.split(IDENTITY_PLACEHOLDER))
+        return template
+
+    def serialise_payload(self, identity, first, last=None):
+        """Splice a category identity into the cached template for a date range."""
+        prefix, suffix = self.payload_template(first, last)
+        return (prefix + json.dumps(identity) + suffix).encode()
+
+    async def fetch_events(self, course, first, last=None):
+        """Fetch a course's raw events between two dates, or None if the request failed."""
+        identity = await self.get_identity(course)
+        if identity is None:
+            return None
+        resp = await self.http.request_json(
+            "POST",
+            "/broker/api/categoryTypes/241e4d36-60e0-49f8-b27e-99416745d98d/categories/events/filter",
+            endpoint="opentimetable events",
+            headers=ReqHeaders,
+            data=self.serialise_payload(identity, first, last),
+        )
+        if resp.data is None:
+            return None
+        return resp.data[0]["CategoryEvents"]
+
+    @staticmethod
+    def index_events(events):
+        """Group raw events into a compact ``{date: [[start, end, name, location], ...]}`` index."""
+        dub = pytz.timezone("Europe/Dublin")
+        parsed = sorted(
+            ((datetime.datetime.fromisoformat(event["StartDateTime"]), event) for event in events),
+            key=itemgetter(0),
+        )
+        days = {}
+        for start, event in parsed:
+            days.setdefault(start.astimezone(dub).date().isoformat(), []).append(
+                [
+                    event["StartDateTime"],
+                    event["EndDateTime"],
+                    event["ExtraProperties"][0]["Value"],
+                    event["Location"],
+                ]
+            )
+        return days
+
+    async def refresh_snapshot(self, course, *, full=False):
+        """Refresh a course's snapshot and return how many days changed.
+
+        A full refresh refetches the whole academic year; otherwise only the current
+        and next week are fetched and diffed against the stored snapshot."""
+        async with self.snapshot_locks[course]:
+            return await self._refresh_snapshot(course, full=full)
+
+    async def ensure_snapshot(self, course):
+        """Fetch a course's snapshot if none is stored or it's older than ``snapshot_ttl``.
+
+        Unbound courses aren't covered by the refresh loop, so this keeps them from going stale.
+        A failed fetch leaves any stored snapshot in place."""
+        async with self.snapshot_locks[course]:
+            snapshot = self.snapshots.get(course)
+            if snapshot is None or time.time() - snapshot["fetched"] > await self.config.snapshot_ttl():
+                await self._refresh_snapshot(course, full=True)
+
+    async def _refresh_snapshot(self, course, *, full):
+        snapshot = self.snapshots.get(course)
+        if snapshot is None or time.time() - snapshot["fetched"] > await self.config.snapshot_ttl():
+            full = True
+        if full:
+            first, last = self.year
+        else:
+            today = datetime.datetime.now().astimezone(pytz.timezone("Europe/Dublin")).date()
+            first = today - datetime.timedelta(days=today.weekday())
+            last = first + datetime.timedelta(days=13)
+        events = await self.fetch_events(course, first, last)
+        if events is None:
+            return None
+        old = {} if snapshot is None else snapshot["days"]
+        if full:
+            days = {}
+        else:
+            days = {
+                day: entries
+                for day, entries in old.items()
+                if not first.isoformat() <= day <= last.isoformat()
+            }
+        days.update(self.index_events(events))
+        changed = sum(1 for day in old.keys() | days.keys() if old.get(day) != days.get(day))
+        self.snapshots[course] = {
+            "fetched": time.time() if full else snapshot["fetched"],
+            "days": days,
+        }
+        if full or changed:
+            self.events[course] = EventIndex(days)
+            self.save_snapshot(course)
+        return changed
+
+    async def refresh_snapshots(self, *, full=False):
+        """Refresh every course's snapshot, returning the changed day count per course."""
+        sem = asyncio.Semaphore(max(1, await self.config.concurrency()))
+
+        async def refresh(course):
+            async with sem:
+                return await self.refresh_snapshot(course, full=full)
+
+        courses = list(await self.courses())
+        results = await asyncio.gather(*(refresh(course) for course in courses), return_exceptions=True)
+        changes = {}
+        for course, result in zip(courses, results):
+            if isinstance(result, BaseException):
+                log.error("Failed to refresh the snapshot for %s", course, exc_info=result)
+                changes[course] = None
+            else:
+                changes[course] = result
+        return changes
+
+    async def refresh_snapshots_loop(self):
+        await self.bot.wait_until_ready()
+        with contextlib.suppress(RuntimeError):
+            while True:
+                await self.refresh_snapshots()
+                await asyncio.sleep(await self.config.refresh_interval())
+
+    def render_day(self, course, day):
+        """Render a course's embed for ``day`` from its event index."""
+        dub = pytz.timezone("Europe/Dublin")
+        embed = discord.Embed(title=f"Timetable for {course} for {day.strftime('%A')} {day.strftime('%d/%m/%Y')}")
+        lo = int(dub.localize(datetime.datetime.combine(day, datetime.time.min)).timestamp())
+        hi = int(
+            dub.localize(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min)).timestamp()
+        )
+        index = self.events.get(course)
+        events = index.between(lo, hi) if index is not None else []
+        embed.description = "".join(self.format_event(event, dub) for event in events) or (
+            f"No classes found for {day.strftime('%A')}"
+        )
+        return embed
+
+    @staticmethod
+    def format_event(event, tz):
+        start = datetime.datetime.fromtimestamp(event.start, tz)
+        end = datetime.datetime.fromtimestamp(event.end, tz)
+        return (
+            f"**{event.name}** | {start.strftime('%I:%M%p').lstrip('0')} - {end.strftime('%I:%M%p').lstrip('0')}"
+            f" - {(event.end - event.start) // 3600}h \n{event.location} - <t:{event.start}:R>\n\n"
+        )
+
     def cog_unload(self):
-        self.bot.loop.create_task(self.session.close())
+        self.bot.loop.create_task(self.http.close())
         self.loop.cancel()
+        self.refresh_loop.cancel()
 
     async def initialise(self):
+        """Catch up on missed runs, then prefetch and publish each scheduled run."""
         await self.bot.wait_until_ready()
-        dub = pytz.timezone("Europe/Dublin")
+        await self.migrate_bindings()
         with contextlib.suppress(RuntimeError):
+            await self.catch_up()
             while True:
                 try:
-                    await self.post_timetables()
-                except Exception as e:
-                    print(e)
-                now = datetime.datetime.now().astimezone(dub)
-                tomorrow = (now + datetime.timedelta(days=1)).replace(hour=20, minute=0, second=0, microsecond=0)
-                await asyncio.sleep((tomorrow - now).total_seconds())
+                    await self.run_next_schedule()
+                except Exception:
+                    log.exception("Scheduled timetable run failed")
+                    await asyncio.sleep(60)
+
+    async def migrate_bindings(self):
+        """Seed the Config bindings from the old hardcoded course table."""
+        if await self.config.schema_version() >= 1:
+            return
+        async with self.config.bindings() as bindings:
+            for course, (channel_id, message_id) in LEGACY_COURSES.items():
+                bindings.setdefault(
+                    str(message_id), {"course": course, "guild_id": LEGACY_GUILD, "channel_id": channel_id}
+                )
+        await self.config.schema_version.set(1)
+
+    async def courses(self):
+        """Return ``{course: {message_id: binding}}`` for every bound message.
+
+        Each course appears once however many messages display it, so it is only
+        fetched and rendered once per run."""
+        courses = defaultdict(dict)
+        for message_id, binding in (await self.config.bindings()).items():
+            courses[binding["course"]][message_id] = binding
+        return courses
+
+    def restart_scheduler(self):
+        self.loop.cancel()
+        self.loop = asyncio.ensure_future(self.initialise())
+
+    async def schedule_times(self):
+        """Return each course's daily publish time."""
+        default = await self.config.publish_time()
+        schedules = await self.config.schedules()
+        return {
+            course: datetime.time.fromisoformat(schedules.get(course, default)) for course in await self.courses()
+        }
+
+    @staticmethod
+    def occurrence(at, now, *, after):
+        """Return the next (``after``) or most recent daily run at ``at`` relative to ``now``."""
+        dub = pytz.timezone("Europe/Dublin")
+        day = now.astimezone(dub).date()
+        candidate = dub.localize(datetime.datetime.combine(day, at))
+        if after and candidate <= now:
+            candidate = dub.localize(datetime.datetime.combine(day + datetime.timedelta(days=1), at))
+        elif not after and candidate > now:
+            candidate = dub.localize(datetime.datetime.combine(day - datetime.timedelta(days=1), at))
+        return candidate
+
+    @staticmethod
+    async def sleep_until(when):
+        delay = when.timestamp() - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run_next_schedule(self):
+        now = datetime.datetime.now(pytz.timezone("Europe/Dublin"))
+        runs = defaultdict(list)
+        for course, at in (await self.schedule_times()).items():
+            runs[self.occurrence(at, now, after=True)].append(course)
+        if not runs:
+            # Nothing is bound; binding a course restarts the scheduler.
+            await asyncio.Event().wait()
+        deadline = min(runs)
+        await self.sleep_until(deadline - datetime.timedelta(seconds=await self.config.prefetch()))
+        embeds = await self.prepare(runs[deadline], self.target_date(now=deadline), refresh=True)
+        await self.sleep_until(deadline)
+        await self.publish(embeds, deadline)
+
+    async def catch_up(self):
+        """Publish any run that was missed while the cog wasn't loaded."""
+        now = datetime.datetime.now(pytz.timezone("Europe/Dublin"))
+        last_published = await self.config.last_published()
+        runs = defaultdict(list)
+        for course, at in (await self.schedule_times()).items():
+            missed = self.occurrence(at, now, after=False)
+            if last_published.get(course, 0) < missed.timestamp():
+                runs[missed].append(course)
+        for deadline, courses in sorted(runs.items()):
+            log.info("Catching up on the %s run for %s", deadline, ", ".join(courses))
+            await self.publish(await self.prepare(courses, self.target_date(now=deadline)), deadline)
+
+    async def prepare(self, courses, day, *, refresh=False):
+        """Render the embeds for ``courses`` ahead of publishing, optionally diff-refreshing first."""
+        sem = asyncio.Semaphore(max(1, await self.config.concurrency()))
+
+        async def prepare_course(course):
+            async with sem:
+                await self.ensure_snapshot(course)
+                if refresh:
+                    await self.refresh_snapshot(course)
+                return self.render_day(course, day)
+
+        results = await asyncio.gather(*(prepare_course(course) for course in courses), return_exceptions=True)
+        embeds = {}
+        for course, result in zip(courses, results):
+            if isinstance(result, BaseException):
+                log.error("Failed to prepare the timetable for %s", course, exc_info=result)
+                self.edit_stats["failed"] += 1
+            else:
+                embeds[course] = result
+        return embeds
+
+    async def publish(self, embeds, deadline):
+        """Publish prepared embeds together and record how late each landed."""
+
+        async def publish_course(course, embed):
+            edited, skipped = await self.publish_embed(course, embed)
+            self.edit_stats["edited"] += edited
+            self.edit_stats["skipped"] += skipped
+            self.lags[course].append(time.time() - deadline.timestamp())
+
+        courses = list(embeds)
+        results = await asyncio.gather(
+            *(publish_course(course, embed) for course, embed in embeds.items()), return_exceptions=True
+        )
+        published = []
+        for course, result in zip(courses, results):
+            if isinstance(result, BaseException):
+                log.error("Failed to publish the timetable for %s", course, exc_info=result)
+                self.edit_stats["failed"] += 1
+            else:
+                published.append(course)
+        async with self.config.last_published() as last_published:
+            for course in published:
+                last_published[course] = deadline.timestamp()
+
+    @staticmethod
+    def target_date(*, skip=False, now=None):
+        """Return the day to post for a run at ``now``, rolling weekends over to the next Monday."""
+        dub = pytz.timezone("Europe/Dublin")
+        now = (now or datetime.datetime.now(dub)).astimezone(dub)
+        if skip:
+            return now.date()
+        day = now.date() + datetime.timedelta(days=1)
+        if day.weekday() == 5:
+            day += datetime.timedelta(days=2)
+        elif day.weekday() == 6:
+            day += datetime.timedelta(days=1)
+        return day
 
     async def post_timetables(self, *, skip=False):
+        """Render and post every course concurrently from the snapshots.
+
+        Each course runs independently so one failure does not affect the others.
+        Per-course timings are kept in ``self.timings``."""
+        today = self.target_date(skip=skip)
+        sem = asyncio.Semaphore(max(1, await self.config.concurrency()))
+        start = time.perf_counter()
+        courses = list(await self.courses())
+        results = await asyncio.gather(
+            *(self._timed_post(sem, course, today) for course in courses),
+            return_exceptions=True,
+        )
+        timings = {}
+        for course, result in zip(courses, results):
+            if isinstance(result, BaseException):
+                log.error("Failed to post the timetable for %s", course, exc_info=result)
+                self.edit_stats["failed"] += 1
+                timings[course] = None
+            else:
+                timings[course] = result
+        timings["total"] = time.perf_counter() - start
+        self.timings = timings
+        return timings
+
+    async def _timed_post(self, sem, course, today):
+        async with sem:
+            start = time.perf_counter()
+            edited, skipped = await self.post_course(course, today)
+            self.edit_stats["edited"] += edited
+            self.edit_stats["skipped"] += skipped
+            return time.perf_counter() - start
+
+    async def post_course(self, course, today):
+        """Post a course's embed, returning how many messages were edited and skipped."""
+        await self.ensure_snapshot(course)
+        return await self.publish_embed(course, self.render_day(course, today))
+
+    async def publish_embed(self, course, embed):
+        """Edit every message bound to a course, skipping those whose embed is unchanged.
+
+        Returns how many messages were edited and skipped."""
+        digest = hashlib.sha256(json.dumps(embed.to_dict(), sort_keys=True).encode()).hexdigest()
+        bindings = (await self.courses()).get(course, {})
+        hashes = await self.config.embed_hashes()
+        stale = [(message_id, binding) for message_id, binding in bindings.items() if hashes.get(message_id) != digest]
+
+        async def edit(message_id, binding):
+            channel = self.bot.get_channel(binding["channel_id"])
+            if channel is None:
+                raise LookupError(f"Channel {binding['channel_id']} not found")
+            await channel.get_partial_message(int(message_id)).edit(embed=embed)
+            await self.config.embed_hashes.set_raw(message_id, value=digest)
+
+        results = await asyncio.gather(*(edit(*item) for item in stale), return_exceptions=True)
+        edited = 0
+        for (message_id, _), result in zip(stale, results):
+            if isinstance(result, BaseException):
+                log.error("Failed to edit the %s timetable message %s", course, message_id, exc_info=result)
+            else:
+                edited += 1
+        return edited, len(bindings) - len(stale)
+
+    @commands.cooldown(3, 60, commands.BucketType.user)
+    @commands.command()
+    async def timetable(self, ctx, course: str, day: str = None):
+        """Show a course's timetable for a day.
+
+        The day can be given as YYYY-MM-DD or DD/MM/YYYY and defaults to the next school day."""
+        course = course.upper()
+        if not course.isalnum():
+            return await ctx.send("That isn't a valid course code.")
+        if day is None:
+            date = self.target_date()
+        else:
+            try:
+                date = datetime.date.fromisoformat(day)
+            except ValueError:
+                try:
+                    date = datetime.datetime.strptime(day, "%d/%m/%Y").date()
+                except ValueError:
+                    return await ctx.send("Dates must be in the format YYYY-MM-DD or DD/MM/YYYY.")
+        await self.ensure_snapshot(course)
+        if course not in self.snapshots:
+            return await ctx.send("I couldn't find a timetable for that course.")
+        await ctx.send(embed=self.render_day(course, date))
+
+    @commands.group()
+    @commands.is_owner()
+    async def autotimetable(self, ctx):
+        """AutoTimetable settings."""
+
+    @autotimetable.command()
+    async def concurrency(self, ctx, limit: int):
+        """Set how many courses are fetched at once."""
+        if limit < 1:
+            return await ctx.send("The limit must be at least 1.")
+        await self.config.concurrency.set(limit)
+        await ctx.tick()
+
+    @autotimetable.command()
+    async def identityttl(self, ctx, days: int):
+        """Set how many days a cached course identity stays valid."""
+        if days < 0:
+            return await ctx.send("The TTL can't be negative.")
+        await self.config.identity_ttl.set(days * 24 * 60 * 60)
+        await ctx.tick()
+
+    @autotimetable.command()
+    async def refreshidentities(self, ctx, *courses: str):
+        """Force a refresh of the cached course identities.
+
+        Refreshes every course if none are given."""
+        courses = [course.upper() for course in courses] or list(await self.courses())
+        async with ctx.typing():
+            identities = await asyncio.gather(
+                *(self.get_identity(course, refresh=True) for course in courses),
+                return_exceptions=True,
+            )
+        lines = [
+            f"{course}: {identity if isinstance(identity, str) else 'failed'}"
+            for course, identity in zip(courses, identities)
+        ]
+        await ctx.send(box("\n".join(lines)))
+
+    @autotimetable.command()
+    async def refreshinterval(self, ctx, hours: int):
+        """Set how often the snapshots are diff-refreshed."""
+        if hours < 1:
+            return await ctx.send("The interval must be at least 1 hour.")
+        await self.config.refresh_interval.set(hours * 60 * 60)
+        await ctx.tick()
+
+    @autotimetable.command()
+    async def refreshsnapshots(self, ctx, full: bool = False):
+        """Refresh the timetable snapshots now and show how many days changed."""
+        async with ctx.typing():
+            changes = await self.refresh_snapshots(full=full)
+        lines = [
+            f"{course}: {'failed' if changed is None else f'{changed} day(s) changed'}"
+            for course, changed in changes.items()
+        ]
+        await ctx.send(box("\n".join(lines)))
+
+    @autotimetable.command()
+    async def run(self, ctx, skip: bool = False):
+        """Post all timetables now and show per-course timings."""
+        async with ctx.typing():
+            timings = await self.post_timetables(skip=skip)
+        total = timings.pop("total")
+        lines = [
+            f"{course}: {'failed' if taken is None else f'{taken:.2f}s'}"
+            for course, taken in timings.items()
+        ]
+        lines.append(f"Total: {total:.2f}s")
+        await ctx.send(box("\n".join(lines)))
+
+    @autotimetable.command()
+    async def stats(self, ctx):
+        """Show how many embed edits were made or skipped since the cog loaded."""
+        await ctx.send(
+            box(
+                f"Edited: {self.edit_stats['edited']}\n"
+                f"Skipped (unchanged): {self.edit_stats['skipped']}\n"
+                f"Failed: {self.edit_stats['failed']}"
+            )
+        )
+
+    @autotimetable.command()
+    async def publishtime(self, ctx, at: str):
+        """Set the default daily publish time (HH:MM, Irish time)."""
         try:
-            dub = pytz.timezone("Europe/Dublin")
-            if not skip:
-                timedel = (datetime.datetime.now()  + datetime.timedelta(days=1)).astimezone(dub)
-                today = timedel.date()
-                if timedel.weekday() == 5:
-                    timedel = (datetime.datetime.now()  + datetime.timedelta(days=3)).astimezone(dub)
-                    today = timedel.date()
-                elif timedel.weekday() == 6:
-                    timedel = (datetime.datetime.now()  + datetime.timedelta(days=2)).astimezone(dub)
-                    today = timedel.date()
+            datetime.time.fromisoformat(at)
+        except ValueError:
+            return await ctx.send("Times must be in the format HH:MM.")
+        await self.config.publish_time.set(at)
+        self.restart_scheduler()
+        await ctx.tick()
+
+    @autotimetable.command()
+    async def schedule(self, ctx, course: str, at: str = None):
+        """Set a course's own publish time (HH:MM), or reset it to the default."""
+        course = course.upper()
+        if course not in await self.courses():
+            return await ctx.send("That course isn't posted by this cog.")
+        async with self.config.schedules() as schedules:
+            if at is None:
+                schedules.pop(course, None)
             else:
-                today = datetime.datetime.now().astimezone(dub).date()
-            for course in COURSES:
-                async with self.session.post(
-                    f"https://opentimetable.dcu.ie/broker/api/CategoryTypes/241e4d36-60e0-49f8-b27e-99416745d98d/Categories/Filter?pageNumber=1&query={course}",
-                    headers=ReqHeaders,
-                ) as req:
-                    if req.status != 200:
-                        continue
-                    data = (await req.json())["Results"][0]["Identity"]
-                self.req_data["CategoryIdentities"][0] = data
-
-                async with self.session.post(
-                    f"https://opentimetable.dcu.ie/broker/api/categoryTypes/241e4d36-60e0-49f8-b27e-99416745d98d/categories/events/filter",
-                    headers=ReqHeaders,
-                    json=self.req_data,
-                ) as req:
-                    if req.status != 200:
-                        continue
-                    timetable = await req.json()
-                embed = discord.Embed(title=f"Timetable for {course} for {today.strftime('%A')} {today.strftime('%d/%m/%Y')}")
-                string = ""
-                for event_obj in sorted(timetable[0]["CategoryEvents"], key=lambda x: datetime.datetime.fromisoformat(x["StartDateTime"])):
-                    start = datetime.datetime.fromisoformat(event_obj["StartDateTime"]).astimezone(dub)
-                    if start.date() != today:  # datetime.datetime.now().date():
-                        # print(f"{start} not today")
-                        continue
-                    end = datetime.datetime.fromisoformat(event_obj["EndDateTime"]).astimezone(dub)
-                    duration = end - start
-
-                    string += f"**{event_obj['ExtraProperties'][0]['Value']}** | {start.strftime('%I:%M%p').lstrip('0')} - {end.strftime('%I:%M%p').lstrip('0')} - {duration.seconds // 3600}h \n{event_obj['Location']} - <t:{int(start.strftime('%s'))}:R>\n\n"
-                if string == "":
-                    string = f"No classes found for {today.strftime('%A')}"
-                embed.description = string
-                guild = self.bot.get_guild(GUILD)
-                channel = guild.get_channel(COURSES[course][0])
-                msg = channel.get_partial_message(COURSES[course][1])
-                await msg.edit(embed=embed)
-        except Exception as e:
-            print(e)
+                try:
+                    datetime.time.fromisoformat(at)
+                except ValueError:
+                    return await ctx.send("Times must be in the format HH:MM.")
+                schedules[course] = at
+        self.restart_scheduler()
+        await ctx.tick()
+
+    @autotimetable.command()
+    async def prefetch(self, ctx, minutes: int):
+        """Set how many minutes before the publish time embeds are prepared."""
+        if minutes < 0:
+            return await ctx.send("The prefetch time can't be negative.")
+        await self.config.prefetch.set(minutes * 60)
+        self.restart_scheduler()
+        await ctx.tick()
+
+    @autotimetable.command()
+    async def lag(self, ctx):
+        """Show how late recent scheduled publishes landed."""
+        times = await self.schedule_times()
+        lines = []
+        for course in times:
+            lags = self.lags.get(course)
+            summary = (
+                f"last {lags[-1]:.2f}s, mean {sum(lags) / len(lags):.2f}s, max {max(lags):.2f}s"
+                if lags
+                else "no runs yet"
+            )
+            lines.append(f"{course} ({times[course].strftime('%H:%M')}): {summary}")
+        await ctx.send(box("\n".join(lines)))
+
+    @autotimetable.command()
+    async def bind(self, ctx, course: str, message: discord.Message):
+        """Keep one of my existing messages updated with a course's timetable."""
+        course = course.upper()
+        if not course.isalnum():
+            return await ctx.send("That isn't a valid course code.")
+        if message.author != ctx.me:
+            return await ctx.send("I can only keep my own messages updated.")
+        await self.add_binding(course, message)
+        await ctx.tick()
+
+    @autotimetable.command()
+    async def post(self, ctx, course: str, channel: discord.TextChannel):
+        """Post a new timetable message for a course in a channel and keep it updated."""
+        course = course.upper()
+        if not course.isalnum():
+            return await ctx.send("That isn't a valid course code.")
+        await self.ensure_snapshot(course)
+        if course not in self.snapshots:
+            return await ctx.send("I couldn't find a timetable for that course.")
+        message = await channel.send(embed=self.render_day(course, self.target_date()))
+        await self.add_binding(course, message)
+        await ctx.tick()
+
+    async def add_binding(self, course, message):
+        await self.config.bindings.set_raw(
+            str(message.id),
+            value={"course": course, "guild_id": message.guild.id, "channel_id": message.channel.id},
+        )
+        await self.config.embed_hashes.clear_raw(str(message.id))
+        self.restart_scheduler()
+
+    @autotimetable.command()
+    async def unbind(self, ctx, message_id: int):
+        """Stop updating a timetable message."""
+        bindings = await self.config.bindings()
+        if str(message_id) not in bindings:
+            return await ctx.send("That message isn't bound to a course.")
+        await self.config.bindings.clear_raw(str(message_id))
+        await self.config.embed_hashes.clear_raw(str(message_id))
+        self.restart_scheduler()
+        await ctx.tick()
+
+    @autotimetable.command()
+    async def bindings(self, ctx):
+        """List the messages kept updated for each course."""
+        courses = await self.courses()
+        if not courses:
+            return await ctx.send("No timetable messages are bound.")
+        lines = [
+            f"{course}: "
+            + ", ".join(
+                f"<#{binding['channel_id']}> ({message_id})" for message_id, binding in sorted(bindings.items())
+            )
+            for course, bindings in sorted(courses.items())
+        ]
+        for page in pagify("\n".join(lines)):
+            await ctx.send(page)
+
+    @autotimetable.command()
+    async def httpstats(self, ctx):
+        """Show opentimetable request latencies."""
+        for page in pagify(self.http.format_latencies()):
+            await ctx.send(box(page))
@@ -0,0 +1,125 @@
+"""Pooled HTTP client for the cog's API requests.
+
+Wraps a single pooled :class:`aiohttp.ClientSession` with timeouts, retries for
+5xx responses and timeouts, and per-endpoint latency histograms."""
+import asyncio
+import logging
+import random
+import time
+from bisect import bisect_left
+from collections import namedtuple
+
+import aiohttp
+
+log = logging.getLogger("red.flare.autotimetable.http")
+
+HTTPResponse = namedtuple("HTTPResponse", ("status", "data"))
+
+
+class LatencyHistogram:
+    """Request latency counts bucketed by upper bound in milliseconds."""
+
+    BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    __slots__ = ("counts", "total", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.errors = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BUCKETS, seconds * 1000)] += 1
+        self.total += seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def __str__(self):
+        labels = [f"<={bucket}ms" for bucket in self.BUCKETS] + [f">{self.BUCKETS[-1]}ms"]
+        buckets = ", ".join(f"{label}: {count}" for label, count in zip(labels, self.counts) if count)
+        mean = self.total / self.count * 1000 if self.count else 0
+        return f"{self.count} requests, {self.errors} errors, mean {mean:.0f}ms ({buckets or 'no data'})"
+
+
+class HTTPClient:
+    """A pooled aiohttp session with retries and latency tracking.
+
+    Request URLs are paths relative to ``base_url``, so the client can be pointed at
+    a local stub server instead of the real API host."""
+
+    RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
+    def __init__(
+        self,
+        *,
+        base_url="",
+        limit_per_host=8,
+        dns_cache_ttl=300,
+        total_timeout=30,
+        connect_timeout=10,
+        retries=3,
+        backoff=0.5,
+    ):
+        self.base_url = base_url
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.latencies = {}
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host, ttl_dns_cache=self.dns_cache_ttl)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def request_json(self, method, url, *, endpoint=None, **kwargs):
+        """Make a request and decode its JSON body.
+
+        5xx responses, timeouts and connection errors are retried with jittered
+        exponential backoff. Returns an :class:`HTTPResponse` whose ``data`` is None
+        for non-200 responses or undecodable bodies."""
+        endpoint = endpoint or url
+        url = self.base_url + url
+        histogram = self.latencies.setdefault(endpoint, LatencyHistogram())
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as resp:
+                    if resp.status in self.RETRY_STATUSES and attempt < self.retries:
+                        histogram.errors += 1
+                        log.debug("%s returned %s, retrying", endpoint, resp.status)
+                    else:
+                        data = None
+                        if resp.status == 200:
+                            try:
+                                data = await resp.json(content_type=None)
+                            except ValueError:
+                                log.warning("%s returned an undecodable body", endpoint)
+                        else:
+                            histogram.errors += 1
+                            log.warning("%s returned %s", endpoint, resp.status)
+                        histogram.observe(time.perf_counter() - start)
+                        return HTTPResponse(resp.status, data)
+                    histogram.observe(time.perf_counter() - start)
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                histogram.errors += 1
+                histogram.observe(time.perf_counter() - start)
+                if attempt == self.retries:
+                    raise
+                log.debug("%s timed out or failed to connect, retrying", endpoint)
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def format_latencies(self):
+        if not self.latencies:
+            return "No requests made yet."
+        return "\n".join(f"{endpoint}: {histogram}" for endpoint, histogram in sorted(self.latencies.items()))
@@ -0,0 +1,109 @@
+"""Benchmark the verified-email store at 10,000 and 100,000 addresses.
+
+Runs Verify's real ``is_email_verified``, ``add_verified_email`` and
+``migrate_verified_emails`` against a Config on Red's JSON driver in a temporary
+directory, next to the old global ``verified_emails`` list accessed the way the cog
+used to. Under the JSON driver every write still serialises the cog's whole
+settings file, so write times grow with the number of stored emails for both
+designs; drivers with per-key storage (Postgres) only pay that for the old list.
+Needs Red installed; run from the repo root with ``python bench/emails.py``."""
+import asyncio
+import random
+import string
+import sys
+import tempfile
+import time
+from itertools import count
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from redbot.core import Config, data_manager  # noqa: E402
+
+try:
+    from redbot.core.drivers import get_driver_class  # noqa: E402
+except ImportError:  # Red 3.5 made the drivers module private.
+    from redbot.core._drivers import get_driver_class  # noqa: E402
+
+from bench.timing import per_call  # noqa: E402
+from verify.verify import USER_DEFAULTS, CountingConfig, Verify  # noqa: E402
+
+SIZES = (10000, 100000)
+
+
+def random_email(rng):
+    first = "".join(rng.choices(string.ascii_lowercase, k=6))
+    last = "".join(rng.choices(string.ascii_lowercase, k=8))
+    return f"{first}.{last}{rng.randrange(100)}@mail.dcu.ie"
+
+
+def make_cog(name):
+    """A Verify with only the Config state the email store uses."""
+    config = Config.get_conf(None, identifier=95932766180343808, cog_name=name, force_registration=True)
+    config.register_global(verified_emails=[], schema_version=0)
+    config.register_user(**USER_DEFAULTS)
+    config.init_custom("EMAIL", 1)
+    config.register_custom("EMAIL", verified=False, user_id=None)
+    cog = object.__new__(Verify)
+    cog.config = CountingConfig(config, lambda: None)
+    return cog
+
+
+async def setup_driver():
+    data_manager.basic_config = {
+        "DATA_PATH": tempfile.mkdtemp(),
+        "COG_PATH_APPEND": "cogs",
+        "CORE_PATH_APPEND": "core",
+        "STORAGE_TYPE": "JSON",
+        "STORAGE_DETAILS": {},
+    }
+    await get_driver_class().initialize()
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    run(setup_driver())
+    rng = random.Random(0)
+    print(
+        f"{'emails':>7} {'list check':>10} {'group check':>11} {'list add':>9} "
+        f"{'group add':>9} {'migration':>9}"
+    )
+    for size in SIZES:
+        emails = [random_email(rng) for _ in range(size)]
+        # Worst case for the scan: an address that isn't verified yet.
+        missing = random_email(rng)
+        cog = make_cog(f"VerifyBench{size}")
+        config = cog.config
+
+        run(config.verified_emails.set(emails))
+        start = time.perf_counter()
+        run(cog.migrate_verified_emails())
+        migration = time.perf_counter() - start
+        assert run(cog.is_email_verified(emails[-1])) and run(config.schema_version()) == 1
+        fresh = (f"new{i}@mail.dcu.ie" for i in count())
+        group_check = per_call(lambda: run(cog.is_email_verified(missing)))
+        group_add = per_call(lambda: run(cog.add_verified_email(next(fresh), 1)), repeat=3)
+
+        # The old store, on its own so each design's file holds only its own emails.
+        run(config.custom("EMAIL").clear())
+        run(config.verified_emails.set(emails))
+
+        async def old_check():
+            return missing in await config.verified_emails()
+
+        async def old_add():
+            async with config.verified_emails() as verified:
+                verified.append(next(fresh))
+
+        list_check = per_call(lambda: run(old_check()))
+        list_add = per_call(lambda: run(old_add()), repeat=3)
+        print(
+            f"{size:>7} {list_check * 1e3:>8.2f}ms {group_check * 1e3:>9.3f}ms {list_add * 1e3:>7.1f}ms "
+            f"{group_add * 1e3:>7.1f}ms {migration * 1e3:>7.0f}ms"
+        )
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
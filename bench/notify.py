@@ -0,0 +1,41 @@
+"""Benchmark Gamenotify.notify's mention fan-out for 10 to 10,000 subscribers.
+
+Times resolving present and departed subscribers against a chunked guild's member
+cache and packing their mentions into messages under Discord's limit. Needs Red installed; run from the
+repo root with ``python bench/notify.py``."""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.timing import per_call  # noqa: E402
+from gamenotify.gamenotify import MESSAGE_LIMIT, pack_mentions  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000)
+DEPARTED = 0.05
+
+
+def fan_out(subscribers, members):
+    # Mirrors Gamenotify.present_members for a chunked guild.
+    present = subscribers & set(members)
+    departed = subscribers - present
+    return pack_mentions("Game: ", [f"<@{user_id}>" for user_id in present]), departed
+
+
+def main():
+    rng = random.Random(0)
+    print(f"{'subscribers':>11} {'messages':>8} {'min msgs':>8} {'fan-out':>10}")
+    for size in SIZES:
+        subscribers = {rng.randrange(10 ** 17, 10 ** 18) for _ in range(size)}
+        # Stand-in for guild.members: a few subscribers have left the guild.
+        members = [user_id for user_id in subscribers if rng.random() > DEPARTED]
+        messages, _ = fan_out(subscribers, members)
+        assert all(len(message) <= MESSAGE_LIMIT for message in messages)
+        lower_bound = -(-sum(map(len, messages)) // MESSAGE_LIMIT)
+        taken = per_call(lambda: fan_out(subscribers, members))
+        print(f"{size:>11} {len(messages):>8} {lower_bound:>8} {taken * 1000:>8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Benchmark per-request serialisation of the opentimetable events payload.
+
+Compares splicing a course identity into the cached pre-serialised template with
+building and ``json.dumps``-ing the payload on every request, for a single day, the
+two weeks a diff refresh fetches and the whole academic year. Also checks that
+interleaved requests for different courses each carry their own identity. Needs Red
+installed; run from the repo root with ``python bench/payload.py``."""
+import datetime
+import json
+import sys
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.timing import per_call  # noqa: E402
+from autotimetable.autotimetable import AutoTimetable  # noqa: E402
+
+
+def payload_builder():
+    """An AutoTimetable with just the state payload building uses; no bot or Config."""
+    cog = object.__new__(AutoTimetable)
+    with open(Path(__file__).resolve().parent.parent / "autotimetable" / "data" / "request.json") as f:
+        cog.req_data = json.load(f)
+    cog.weeks = AutoTimetable.build_weeks(cog.req_data["ViewOptions"]["DateConfig"])
+    first_week = datetime.date.fromisoformat(cog.weeks[0]["FirstDayInWeek"][:10])
+    cog.year = (first_week, first_week + datetime.timedelta(days=7 * len(cog.weeks) - 1))
+    cog.templates = {}
+    return cog
+
+
+def main():
+    cog = payload_builder()
+    first = cog.year[0] + datetime.timedelta(days=7 * 6 + 1)
+    ranges = {
+        "day": (first, first),
+        "two weeks": (first, first + datetime.timedelta(days=13)),
+        "year": cog.year,
+    }
+    identities = [str(uuid.UUID(int=i)) for i in range(8)]
+    identity = identities[0]
+
+    for first_day, last_day in ranges.values():
+        bodies = [cog.serialise_payload(identity, first_day, last_day) for identity in identities]
+        for identity, body in zip(identities, bodies):
+            decoded = json.loads(body)
+            assert decoded["CategoryIdentities"] == [identity]
+            assert decoded == cog.build_payload(identity, first_day, last_day)
+
+    print(f"{'range':>10} {'bytes':>7} {'splice':>9} {'dumps':>9}")
+    for name, (first_day, last_day) in ranges.items():
+        size = len(cog.serialise_payload(identity, first_day, last_day))
+        splice = per_call(lambda: cog.serialise_payload(identity, first_day, last_day))
+        dumps = per_call(lambda: json.dumps(cog.build_payload(identity, first_day, last_day)).encode())
+        print(f"{name:>10} {size:>7} {splice * 1e6:>7.2f}us {dumps * 1e6:>7.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark rendering a day's timetable from a full year of events.
+
+Compares the original render loop, which re-parsed and re-sorted every event of the
+year for each day, with the snapshot index: a one-off ``index_events`` and
+``EventIndex`` build, then a bisect per day.
+
+Pass a recorded opentimetable events response (the JSON body of the events filter
+request) to benchmark real data; otherwise a synthetic academic year of the same
+shape is generated. Needs Red installed; run from the repo root with
+``python bench/render.py [payload.json]``."""
+import datetime
+import json
+import random
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import discord
+import pytz
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.timing import per_call  # noqa: E402
+from autotimetable.autotimetable import AutoTimetable, EventIndex  # noqa: E402
+
+COURSE = "CASE3"
+DUB = pytz.timezone("Europe/Dublin")
+
+
+def synthetic_year(seed=0):
+    """About 2,000 events over 30 teaching weeks, with some sharing a start time."""
+    rng = random.Random(seed)
+    events = []
+    first = datetime.date(2021, 9, 27)
+    for day in (first + datetime.timedelta(days=offset) for offset in range(7 * 30)):
+        if day.weekday() >= 5:
+            continue
+        for hour in range(9, 18):
+            for _ in range(rng.choice((1, 1, 2, 2, 3))):
+                start = DUB.localize(datetime.datetime.combine(day, datetime.time(hour)))
+                end = start + datetime.timedelta(hours=rng.choice((1, 1, 2)))
+                events.append(
+                    {
+                        "StartDateTime": start.isoformat(),
+                        "EndDateTime": end.isoformat(),
+                        "ExtraProperties": [{"Value": f"CA{rng.randrange(100, 400)} Lecture"}],
+                        "Location": f"GLA.LG{rng.randrange(1, 30)}",
+                    }
+                )
+    rng.shuffle(events)
+    return events
+
+
+def load_events(path):
+    with open(path) as f:
+        data = json.load(f)
+    return data[0]["CategoryEvents"] if data and "CategoryEvents" in data[0] else data
+
+
+def old_render(events, today):
+    """The render loop from before the snapshot index, minus the HTTP requests."""
+    embed = discord.Embed(title=f"Timetable for {COURSE} for {today.strftime('%A')} {today.strftime('%d/%m/%Y')}")
+    string = ""
+    for event_obj in sorted(events, key=lambda x: datetime.datetime.fromisoformat(x["StartDateTime"])):
+        start = datetime.datetime.fromisoformat(event_obj["StartDateTime"]).astimezone(DUB)
+        if start.date() != today:
+            continue
+        end = datetime.datetime.fromisoformat(event_obj["EndDateTime"]).astimezone(DUB)
+        duration = end - start
+        string += (
+            f"**{event_obj['ExtraProperties'][0]['Value']}** | {start.strftime('%I:%M%p').lstrip('0')} - "
+            f"{end.strftime('%I:%M%p').lstrip('0')} - {duration.seconds // 3600}h \n{event_obj['Location']} - "
+            f"<t:{int(start.strftime('%s'))}:R>\n\n"
+        )
+    if string == "":
+        string = f"No classes found for {today.strftime('%A')}"
+    embed.description = string
+    return embed
+
+
+def main():
+    events = load_events(sys.argv[1]) if len(sys.argv) > 1 else synthetic_year()
+    days = AutoTimetable.index_events(events)
+    busiest = max(days, key=lambda day: len(days[day]))
+    today = datetime.date.fromisoformat(busiest)
+    cog = SimpleNamespace(events={COURSE: EventIndex(days)}, format_event=AutoTimetable.format_event)
+
+    old = old_render(events, today)
+    new = AutoTimetable.render_day(cog, COURSE, today)
+    assert old.description.count("**") == new.description.count("**")
+
+    build = per_call(lambda: EventIndex(AutoTimetable.index_events(events)))
+    old_day = per_call(lambda: old_render(events, today))
+    new_day = per_call(lambda: AutoTimetable.render_day(cog, COURSE, today))
+    print(f"{len(events)} events, rendering {busiest} ({len(days[busiest])} events)")
+    print(f"old render loop:       {old_day * 1000:.3f}ms per day")
+    print(f"index lookup + render: {new_day * 1000:.3f}ms per day")
+    print(f"index build:           {build * 1000:.3f}ms per snapshot refresh")
+
+
+if __name__ == "__main__":
+    main()
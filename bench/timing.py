@@ -0,0 +1,11 @@
+"""Timing helper shared by the benchmark scripts."""
+import timeit
+
+
+def per_call(func, repeat=5):
+    """Return the best-of-``repeat`` time in seconds for one call of ``func``.
+
+    The number of calls per run is picked by ``timeit``'s autorange."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
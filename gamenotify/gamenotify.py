@@ -1,11 +1,77 @@
+import asyncio
+import contextlib
 import logging
+from collections import defaultdict
+from collections.abc import Sequence
 
 import discord
 from redbot.core import Config, bank, commands
-from redbot.core.utils.chat_formatting import escape, humanize_list, humanize_number, inline
+from redbot.core.utils.chat_formatting import box, escape, humanize_list, humanize_number, inline
+from redbot.core.utils.menus import start_adding_reactions
+from redbot.core.utils.predicates import MessagePredicate, ReactionPredicate
+
+from .subscriptions import SubscriptionStore
 
 log = logging.getLogger("red.flare.gamenotify")
 
+MESSAGE_LIMIT = 2000
+ROLE_EDIT_BATCH = 10
+ROLE_EDIT_BATCH_DELAY = 1
+PAGE_SIZE = 30
+MENU_TIMEOUT = 60
+QUERY_MEMBERS_LIMIT = 100
+# Same emojis as Red's DEFAULT_CONTROLS, mapped to the page step they take.
+PAGE_CONTROLS = {
+    "\N{LEFTWARDS BLACK ARROW}\N{VARIATION SELECTOR-16}": -1,
+    "\N{CROSS MARK}": None,
+    "\N{BLACK RIGHTWARDS ARROW}\N{VARIATION SELECTOR-16}": 1,
+}
+
+
+def pack_mentions(prefix, mentions, limit=MESSAGE_LIMIT):
+    """Pack comma separated mentions into as few messages under ``limit`` as possible.
+
+    The first message starts with ``prefix``."""
+    messages = []
+    current = prefix
+    empty = True
+    for mention in mentions:
+        addition = mention if empty else f",{mention}"
+        if len(current) + len(addition) > limit and not empty:
+            messages.append(current)
+            current, addition = "", mention
+        current += addition
+        empty = False
+    if not empty:
+        messages.append(current)
+    return messages
+
+
+class LazyPages(Sequence):
+    """Menu pages over a list of items, formatted only when a page is viewed.
+
+    ``render`` turns one item into a line of text, or None to leave it out."""
+
+    def __init__(self, title, items, render, per_page=PAGE_SIZE):
+        self.title = title
+        self.items = items
+        self.render = render
+        self.per_page = per_page
+
+    def __len__(self):
+        return max(1, -(-len(self.items) // self.per_page))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        chunk = self.items[index * self.per_page : (index + 1) * self.per_page]
+        lines = [line for line in map(self.render, chunk) if line is not None]
+        return f"{self.title} (page {index + 1}/{len(self)}):\n" + "\n".join(lines)
+
 
 class Gamenotify(commands.Cog):
     """Sub to game pings"""
@@ -19,99 +85,361 @@ class Gamenotify(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.config = Config.get_conf(self, 95932766180343808, force_registration=True)
-        self.config.register_guild(games={})
+        self.config.register_guild(games={}, role_threshold=None)
+        self.config.init_custom("GAME", 2)
+        self.config.register_custom("GAME", name=None, role_id=None, aliases=[])
+        self.config.init_custom("SUBSCRIBER", 3)
+        self.config.register_custom("SUBSCRIBER", subscribed=False)
+        self.store = SubscriptionStore(self.config)
+        self.convert_locks = defaultdict(asyncio.Lock)
+        self.conversions = set()
+
+    def cog_unload(self):
+        for task in self.conversions:
+            task.cancel()
 
     @commands.cooldown(1, 300, commands.BucketType.user)
     @commands.command()
     @commands.guild_only()
     async def notify(self, ctx, *, game: str):
         """Ping a game."""
-        game = game.lower()
-        games = await self.config.guild(ctx.guild).games()
-        if game not in games:
-            await ctx.send(
-                f"That game doesn't exist, did you mean one of the following? {humanize_list(list(map(inline, games.keys())))}"
-            )
+        index = await self.store.get(ctx.guild)
+        games = index.games
+        name, game = game.lower(), index.names.resolve(game.lower())
+        if game is None:
+            await ctx.send(f"That game doesn't exist.{self.format_suggestions(index, name)}")
             return
         if ctx.author.id not in games[game]:
             await ctx.send(f"You must be signed up for {game} pings in order to notify it's other members.")
             return
-        users = []
-        for user in games[game]:
-            obj = ctx.guild.get_member(user)
-            if obj is None:
-                continue
-            users.append(obj.mention)
-        if not users:
+        role = await self.get_game_role(ctx.guild, game, index)
+        if role is not None:
+            await ctx.send(
+                f"{escape(game, mass_mentions=True).title()}: {role.mention}",
+                allowed_mentions=discord.AllowedMentions(roles=[role]),
+            )
+            return
+        present = await self.present_members(ctx.guild, games[game])
+        departed = games[game] - present
+        if departed and ctx.guild.chunked:
+            await self.store.unsubscribe_many(ctx.guild, game, departed)
+        if not present:
             await ctx.send("Nobody is signed up for pings for that game.")
             return
-        msg = f"{escape(game, mass_mentions=True).title()}: {','.join(users)}"
-        await ctx.send(msg)
+        messages = pack_mentions(
+            f"{escape(game, mass_mentions=True).title()}: ", [f"<@{user_id}>" for user_id in present]
+        )
+        # Sent one after another so the message with the game's name always comes first.
+        for content in messages:
+            await ctx.send(content)
 
     @commands.command()
     @commands.guild_only()
     async def addping(self, ctx, *, game: str):
         """Add/remove a ping for a game."""
-        game = game.lower()
-        async with self.config.guild(ctx.guild).games() as games:
-            if game in games:
-                if ctx.author.id in games[game]:
-                    games[game].remove(ctx.author.id)
-                    await ctx.send("You have been removed from pings for this game.")
-                else:
-                    games[game].append(ctx.author.id)
-                    await ctx.send(
-                        f"You have been added to the ping list for {escape(game, mass_mentions=True)}."
-                    )
+        index = await self.store.get(ctx.guild)
+        games = index.games
+        game = index.names.resolve(game.lower()) or game.lower()
+        if game in games:
+            role = await self.get_game_role(ctx.guild, game, index)
+            if ctx.author.id in games[game]:
+                await self.store.unsubscribe(ctx.guild, game, ctx.author.id)
+                if role is not None:
+                    await ctx.author.remove_roles(role, reason="Game ping removed")
+                await ctx.send("You have been removed from pings for this game.")
             else:
-                games[game] = []
-                games[game].append(ctx.author.id)
+                await self.store.subscribe(ctx.guild, game, ctx.author.id)
+                if role is not None:
+                    await ctx.author.add_roles(role, reason="Game ping added")
+                await ctx.send(
+                    f"You have been added to the ping list for {escape(game, mass_mentions=True)}."
+                )
+                if role is None:
+                    self.schedule_conversion(ctx.guild, game, index)
+        else:
+            suggestions = index.names.suggest(game)
+            if suggestions:
                 await ctx.send(
-                    "That game has now been created and you have added to the ping list"
+                    f"That game doesn't exist.{self.format_suggestions(index, game)}\n"
+                    f"Do you want to create {inline(game)} as a new game anyway? (yes/no)"
                 )
+                try:
+                    pred = MessagePredicate.yes_or_no(ctx, user=ctx.author)
+                    await ctx.bot.wait_for("message", check=pred, timeout=30)
+                except asyncio.TimeoutError:
+                    await ctx.send("Exiting operation.")
+                    return
+                if not pred.result:
+                    await ctx.send("Operation cancelled.")
+                    return
+            await self.store.add_game(ctx.guild, game)
+            await self.store.subscribe(ctx.guild, game, ctx.author.id)
+            await ctx.send(
+                "That game has now been created and you have added to the ping list"
+            )
 
     @commands.command()
     @commands.guild_only()
     async def listgames(self, ctx):
         """List games for notifying."""
-        games = await self.config.guild(ctx.guild).games()
-        if not games:
-            await ctx.send("No games are registered in this guild silly.")
-            return
-        new_games = [game for game in games if games[game]]
+        games = (await self.store.get(ctx.guild)).games
+        new_games = sorted(game for game in games if games[game])
         if not new_games:
             await ctx.send("No games are registered in this guild silly.")
             return
-        await ctx.send(f"Current registered games: {humanize_list(list(map(inline, new_games)))}")
+        await self.send_pages(ctx, LazyPages("Current registered games", new_games, inline))
 
     @commands.command()
     @commands.guild_only()
     async def listpings(self, ctx, *, game: str):
         """List pings for a game."""
-        games = await self.config.guild(ctx.guild).games()
-        if game.lower() not in games:
-            await ctx.send("That game isn't registered for pings.")
+        index = await self.store.get(ctx.guild)
+        games = index.games
+        name, game = game.lower(), index.names.resolve(game.lower())
+        if game is None:
+            await ctx.send(f"That game isn't registered for pings.{self.format_suggestions(index, name)}")
             return
-        users = []
-        for user in games[game.lower()]:
-            obj = ctx.guild.get_member(user)
-            if obj is not None:
-                users.append(str(obj))
-        if not users:
+        # Filtered up front so every page is full and the page count is right.
+        present = list(await self.present_members(ctx.guild, games[game]))
+        if not present:
             await ctx.send(f"No valid users registered for {game}.")
-        await ctx.send(
-            f"Current registered users for {game}: {humanize_list(list(map(inline, users)))}"
+            return
+
+        def render(user_id):
+            member = ctx.guild.get_member(user_id)
+            return None if member is None else inline(str(member))
+
+        await self.send_pages(
+            ctx, LazyPages(f"Current registered users for {escape(game, mass_mentions=True)}", present, render)
         )
 
+    @staticmethod
+    async def send_pages(ctx, pages, timeout=MENU_TIMEOUT):
+        """Show pages behind reaction controls, indexing only the page being viewed.
+
+        Red's ``menu`` type-checks every page on each turn, which would render them all."""
+        page = 0
+        message = await ctx.send(pages[page])
+        if len(pages) == 1:
+            return
+        start_adding_reactions(message, PAGE_CONTROLS)
+        while True:
+            pred = ReactionPredicate.with_emojis(tuple(PAGE_CONTROLS), message, ctx.author)
+            try:
+                reaction, user = await ctx.bot.wait_for("reaction_add", check=pred, timeout=timeout)
+            except asyncio.TimeoutError:
+                with contextlib.suppress(discord.HTTPException):
+                    await message.clear_reactions()
+                return
+            step = PAGE_CONTROLS[str(reaction.emoji)]
+            if step is None:
+                with contextlib.suppress(discord.HTTPException):
+                    await message.delete()
+                return
+            with contextlib.suppress(discord.HTTPException):
+                await message.remove_reaction(reaction.emoji, user)
+            page = (page + step) % len(pages)
+            await message.edit(content=pages[page])
+
     @commands.command()
     @commands.guild_only()
     @commands.mod()
     async def delgame(self, ctx, *, game: str):
         """Deletea game."""
-        game = game.lower()
-        async with self.config.guild(ctx.guild).games() as games:
-            if game in games:
-                del games[game]
-                await ctx.send("That game has now deleted.")
-            else:
-                await ctx.send("That game does not exist.")
+        index = await self.store.get(ctx.guild)
+        game = index.names.resolve(game.lower())
+        if game is not None:
+            role = await self.get_game_role(ctx.guild, game, index)
+            await self.store.remove_game(ctx.guild, game)
+            if role is not None:
+                try:
+                    await role.delete(reason="Game ping deleted")
+                except discord.HTTPException:
+                    log.exception("Failed to delete the %s role for %s in %s", role, game, ctx.guild.id)
+                    await ctx.send("That game has now deleted, but I couldn't delete its ping role.")
+                    return
+            await ctx.send("That game has now deleted.")
+        else:
+            await ctx.send("That game does not exist.")
+
+    @staticmethod
+    def format_suggestions(index, name):
+        suggestions = index.names.suggest(name)
+        if not suggestions:
+            return ""
+        return f" Did you mean one of the following? {humanize_list(list(map(inline, suggestions)))}"
+
+    async def present_members(self, guild, user_ids):
+        """Return the IDs in ``user_ids`` that belong to current members of ``guild``.
+
+        A chunked guild is answered by one intersection with its member cache. Otherwise
+        the uncached IDs are looked up over the gateway, ``QUERY_MEMBERS_LIMIT`` at a time."""
+        if guild.chunked:
+            return user_ids & {member.id for member in guild.members}
+        present = {user_id for user_id in user_ids if guild.get_member(user_id) is not None}
+        missing = list(user_ids - present)
+        if not missing or not self.bot.intents.members:
+            return present
+        for start in range(0, len(missing), QUERY_MEMBERS_LIMIT):
+            try:
+                members = await guild.query_members(
+                    user_ids=missing[start : start + QUERY_MEMBERS_LIMIT], limit=QUERY_MEMBERS_LIMIT, cache=True
+                )
+            except asyncio.TimeoutError:
+                log.warning("Timed out querying members of %s", guild.id)
+                break
+            present.update(member.id for member in members)
+        return present
+
+    async def get_game_role(self, guild, game, index):
+        """Return the managed role backing a game, if it has one that still exists."""
+        role_id = index.roles.get(game)
+        if role_id is None:
+            return None
+        role = guild.get_role(role_id)
+        if role is None:
+            await self.store.set_role(guild, game, None)
+        return role
+
+    def schedule_conversion(self, guild, game, index):
+        """Run :meth:`maybe_convert_to_role` in the background.
+
+        A conversion hands the role out in paced batches, so the command replies first."""
+        task = self.bot.loop.create_task(self.maybe_convert_to_role(guild, game, index))
+        self.conversions.add(task)
+        task.add_done_callback(self.conversions.discard)
+
+    async def maybe_convert_to_role(self, guild, game, index):
+        """Convert a game to a role-backed ping once it reaches the guild's threshold.
+
+        Failures are logged rather than raised, since this runs outside any command."""
+        threshold = await self.config.guild(guild).role_threshold()
+        if threshold is None or len(index.games[game]) < threshold:
+            return None
+        try:
+            return await self.convert_to_role(guild, game, index)
+        except discord.Forbidden:
+            log.warning("Missing permissions to create a ping role for %s in %s", game, guild.id)
+        except Exception:
+            log.exception("Failed to convert %s to a role-backed ping in %s", game, guild.id)
+        return None
+
+    async def convert_to_role(self, guild, game, index):
+        """Create a managed role for a game and give it to every current subscriber.
+
+        Conversions of the same game are serialised, so concurrent callers share one role."""
+        async with self.convert_locks[(guild.id, game)]:
+            role = await self.get_game_role(guild, game, index)
+            if role is not None:
+                return role
+            role = await guild.create_role(
+                name=f"{game.title()} Pings", mentionable=True, reason="Game ping converted to a role"
+            )
+            await self.store.set_role(guild, game, role.id)
+        members = [
+            member
+            for member in map(guild.get_member, list(index.games[game]))
+            if member is not None and role not in member.roles
+        ]
+        await self.add_role_in_batches(role, members, reason="Game ping converted to a role")
+        return role
+
+    @staticmethod
+    async def add_role_in_batches(role, members, *, reason):
+        """Give ``role`` to ``members`` a batch at a time, pausing between batches.
+
+        Discord has no bulk role assignment, so each member is still one request; batching keeps
+        a large conversion from queueing hundreds of edits on the guild's rate limit at once."""
+        for start in range(0, len(members), ROLE_EDIT_BATCH):
+            if start:
+                await asyncio.sleep(ROLE_EDIT_BATCH_DELAY)
+            batch = members[start : start + ROLE_EDIT_BATCH]
+            results = await asyncio.gather(
+                *(member.add_roles(role, reason=reason) for member in batch), return_exceptions=True
+            )
+            for member, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    log.error("Failed to give %s the %s role", member, role, exc_info=result)
+
+    @commands.group()
+    @commands.guild_only()
+    @commands.admin_or_permissions(manage_guild=True)
+    async def gamenotifyset(self, ctx):
+        """Gamenotify settings."""
+
+    @gamenotifyset.command()
+    async def threshold(self, ctx, subscribers: int = None):
+        """Back games with at least this many subscribers by a pingable role.
+
+        Leave empty to disable role-backed pings for new games."""
+        if subscribers is not None and subscribers < 1:
+            await ctx.send("The threshold must be at least 1.")
+            return
+        await self.config.guild(ctx.guild).role_threshold.set(subscribers)
+        await ctx.tick()
+
+    @gamenotifyset.command()
+    @commands.bot_has_permissions(manage_roles=True)
+    async def convert(self, ctx):
+        """Convert every game over the threshold to a role-backed ping."""
+        threshold = await self.config.guild(ctx.guild).role_threshold()
+        if threshold is None:
+            await ctx.send("Set a threshold first.")
+            return
+        index = await self.store.get(ctx.guild)
+        games = [
+            game for game, users in index.games.items() if len(users) >= threshold and game not in index.roles
+        ]
+        async with ctx.typing():
+            for game in games:
+                await self.convert_to_role(ctx.guild, game, index)
+        await ctx.send(f"Converted {len(games)} game(s) to role pings.")
+
+    @gamenotifyset.command()
+    async def alias(self, ctx, alias: str, *, game: str):
+        """Add an alias for a game.
+
+        Use quotes for aliases containing spaces."""
+        index = await self.store.get(ctx.guild)
+        alias, canonical = alias.lower(), index.names.resolve(game.lower())
+        if canonical is None:
+            await ctx.send(f"That game doesn't exist.{self.format_suggestions(index, game.lower())}")
+            return
+        if index.names.resolve(alias) is not None:
+            await ctx.send("That name is already used by a game or alias.")
+            return
+        await self.store.add_alias(ctx.guild, alias, canonical)
+        await ctx.tick()
+
+    @gamenotifyset.command()
+    async def unalias(self, ctx, *, alias: str):
+        """Remove a game alias."""
+        if await self.store.remove_alias(ctx.guild, alias.lower()):
+            await ctx.tick()
+        else:
+            await ctx.send("That isn't an alias.")
+
+    @gamenotifyset.command()
+    @commands.is_owner()
+    async def cache(self, ctx):
+        """Show subscription cache statistics."""
+        await ctx.send(box(str(self.store)))
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        index = self.store.guilds.get(role.guild.id)
+        if index is None:
+            return
+        for game, role_id in list(index.roles.items()):
+            if role_id == role.id:
+                await self.store.set_role(role.guild, game, None)
+
+    @commands.command()
+    @commands.guild_only()
+    async def mypings(self, ctx):
+        """List the games you are signed up to pings for."""
+        games = (await self.store.get(ctx.guild)).users.get(ctx.author.id)
+        if not games:
+            await ctx.send("You aren't signed up for any game pings.")
+            return
+        await ctx.send(f"You are signed up for: {humanize_list(list(map(inline, sorted(games))))}")
@@ -0,0 +1,59 @@
+from collections import Counter, defaultdict
+
+
+def trigrams(name):
+    padded = f"  {name} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """Trigram index over a guild's game names and aliases.
+
+    ``names`` maps every known name, canonical or alias, to its canonical game."""
+
+    __slots__ = ("names", "grams", "postings")
+
+    def __init__(self):
+        self.names = {}
+        self.grams = {}
+        self.postings = defaultdict(set)
+
+    def add(self, name, game):
+        self.names[name] = game
+        self.grams[name] = grams = trigrams(name)
+        for gram in grams:
+            self.postings[gram].add(name)
+
+    def remove(self, name):
+        self.names.pop(name, None)
+        for gram in self.grams.pop(name, ()):
+            names = self.postings[gram]
+            names.discard(name)
+            if not names:
+                del self.postings[gram]
+
+    def remove_game(self, game):
+        for name in [name for name, canonical in self.names.items() if canonical == game]:
+            self.remove(name)
+
+    def resolve(self, name):
+        """Return the canonical game for an exact name or alias."""
+        return self.names.get(name)
+
+    def suggest(self, name, k=5, cutoff=0.3):
+        """Return up to ``k`` canonical games closest to ``name``, best first."""
+        query = trigrams(name)
+        shared = Counter()
+        for gram in query:
+            shared.update(self.postings.get(gram, ()))
+        scores = {}
+        for candidate, count in shared.items():
+            # Blend of Jaccard similarity and how much of the query the candidate covers,
+            # so short typos of long names still score well.
+            score = (count / (len(query) + len(self.grams[candidate]) - count) + count / len(query)) / 2
+            if candidate.startswith(name):
+                score += 0.5
+            game = self.names[candidate]
+            if score >= cutoff and score > scores.get(game, 0):
+                scores[game] = score
+        return sorted(scores, key=scores.get, reverse=True)[:k]
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import sys
+from collections import OrderedDict, defaultdict
+
+from .names import NameIndex
+
+log = logging.getLogger("red.flare.gamenotify")
+
+
+class GuildSubscriptions:
+    """Set-based subscription index for one guild.
+
+    ``games`` maps each game to its subscriber IDs and ``users`` maps each user ID
+    to the games they are subscribed to. ``roles`` maps role-backed games to their
+    managed role ID and ``names`` indexes game names and aliases for lookups."""
+
+    __slots__ = ("games", "users", "roles", "names")
+
+    def __init__(self):
+        self.games = {}
+        self.users = defaultdict(set)
+        self.roles = {}
+        self.names = NameIndex()
+
+    def add_game(self, game):
+        if game not in self.games:
+            self.games[game] = set()
+            self.names.add(game, game)
+
+    def subscribe(self, game, user_id):
+        self.add_game(game)
+        self.games[game].add(user_id)
+        self.users[user_id].add(game)
+
+    def unsubscribe(self, game, user_id):
+        self.games.get(game, set()).discard(user_id)
+        games = self.users.get(user_id)
+        if games is not None:
+            games.discard(game)
+            if not games:
+                del self.users[user_id]
+
+    def remove_game(self, game):
+        self.roles.pop(game, None)
+        self.names.remove_game(game)
+        for user_id in self.games.pop(game, set()):
+            self.unsubscribe(game, user_id)
+
+    def memory_usage(self):
+        """Rough size in bytes of the index's containers and their contents."""
+        size = sys.getsizeof(self.games) + sys.getsizeof(self.users) + sys.getsizeof(self.roles)
+        for game, users in self.games.items():
+            size += sys.getsizeof(game) + sys.getsizeof(users) + 28 * len(users)
+        for games in self.users.values():
+            size += 28 + sys.getsizeof(games)
+        size += sys.getsizeof(self.names.names) + sys.getsizeof(self.names.postings)
+        for grams in self.names.grams.values():
+            size += sys.getsizeof(grams)
+        for names in self.names.postings.values():
+            size += sys.getsizeof(names)
+        return size
+
+
+class SubscriptionStore:
+    """Per-guild subscription indexes persisted one entry at a time.
+
+    Games live in the ``GAME`` custom group keyed by (guild, game) and subscriptions
+    in ``SUBSCRIBER`` keyed by (guild, game, user), so a toggle writes one entry
+    instead of the whole guild blob.
+
+    Loaded indexes are kept in an LRU of at most ``max_guilds`` guilds and every
+    write goes through to both the index and Config, so reads never touch Config
+    while a guild is cached."""
+
+    def __init__(self, config, *, max_guilds=100):
+        self.config = config
+        self.max_guilds = max_guilds
+        self.guilds = OrderedDict()
+        self.locks = defaultdict(asyncio.Lock)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, guild):
+        """Return the guild's index, loading it from Config on first use.
+
+        Counted in the hit rate, so commands should call this once and pass the index on."""
+        if guild.id in self.guilds:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return await self._index(guild)
+
+    async def _index(self, guild):
+        """Like :meth:`get`, but without counting towards the hit rate; used by the writes."""
+        index = self.guilds.get(guild.id)
+        if index is not None:
+            self.guilds.move_to_end(guild.id)
+            return index
+        async with self.locks[guild.id]:
+            if guild.id not in self.guilds:
+                self.guilds[guild.id] = await self._load(guild)
+                self._evict()
+        return self.guilds[guild.id]
+
+    def _evict(self):
+        for guild_id in list(self.guilds):
+            if len(self.guilds) <= self.max_guilds:
+                break
+            if not self.locks[guild_id].locked():
+                del self.guilds[guild_id]
+                del self.locks[guild_id]
+
+    def __str__(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        memory = sum(index.memory_usage() for index in self.guilds.values())
+        return (
+            f"{len(self.guilds)}/{self.max_guilds} guilds cached, {self.hits} hits, {self.misses} misses "
+            f"({rate:.0f}% hit rate), ~{memory / 1024:.1f} KiB"
+        )
+
+    async def _load(self, guild):
+        await self._migrate(guild)
+        index = GuildSubscriptions()
+        for game, data in (await self.config.custom("GAME", str(guild.id)).all()).items():
+            index.add_game(game)
+            if data.get("role_id") is not None:
+                index.roles[game] = data["role_id"]
+            for alias in data.get("aliases", []):
+                index.names.add(alias, game)
+        subscribers = await self.config.custom("SUBSCRIBER", str(guild.id)).all()
+        for game, users in subscribers.items():
+            for user_id, data in users.items():
+                if data.get("subscribed"):
+                    index.subscribe(game, int(user_id))
+        return index
+
+    async def _migrate(self, guild):
+        """Move the legacy guild-level ``games`` dict into the custom groups."""
+        games = await self.config.guild(guild).games()
+        if not games:
+            return
+        await self.config.custom("GAME", str(guild.id)).set({game: {"name": game} for game in games})
+        await self.config.custom("SUBSCRIBER", str(guild.id)).set(
+            {
+                game: {str(user_id): {"subscribed": True} for user_id in users}
+                for game, users in games.items()
+            }
+        )
+        await self.config.guild(guild).games.clear()
+        log.info("Migrated %s games in %s", len(games), guild.id)
+
+    async def add_game(self, guild, game):
+        index = await self._index(guild)
+        if game not in index.games:
+            index.add_game(game)
+            await self.config.custom("GAME", str(guild.id), game).set({"name": game})
+
+    async def set_role(self, guild, game, role_id):
+        """Back a game with a managed role, or stop doing so if ``role_id`` is None."""
+        index = await self._index(guild)
+        if role_id is None:
+            index.roles.pop(game, None)
+        else:
+            index.roles[game] = role_id
+        await self.config.custom("GAME", str(guild.id), game).role_id.set(role_id)
+
+    async def add_alias(self, guild, alias, game):
+        index = await self._index(guild)
+        index.names.add(alias, game)
+        async with self.config.custom("GAME", str(guild.id), game).aliases() as aliases:
+            aliases.append(alias)
+
+    async def remove_alias(self, guild, alias):
+        """Remove an alias, returning False if it isn't one."""
+        index = await self._index(guild)
+        game = index.names.resolve(alias)
+        if game is None or game == alias:
+            return False
+        index.names.remove(alias)
+        async with self.config.custom("GAME", str(guild.id), game).aliases() as aliases:
+            if alias in aliases:
+                aliases.remove(alias)
+        return True
+
+    async def subscribe(self, guild, game, user_id):
+        index = await self._index(guild)
+        index.subscribe(game, user_id)
+        await self.config.custom("SUBSCRIBER", str(guild.id), game, str(user_id)).set({"subscribed": True})
+
+    async def unsubscribe(self, guild, game, user_id):
+        index = await self._index(guild)
+        index.unsubscribe(game, user_id)
+        await self.config.custom("SUBSCRIBER", str(guild.id), game, str(user_id)).clear()
+
+    async def unsubscribe_many(self, guild, game, user_ids):
+        """Unsubscribe several users from a game with a single write of its subscribers.
+
+        The write is built from the index, which every subscription goes through first."""
+        index = await self._index(guild)
+        for user_id in user_ids:
+            index.unsubscribe(game, user_id)
+        await self.config.custom("SUBSCRIBER", str(guild.id), game).set(
+            {str(user_id): {"subscribed": True} for user_id in index.games.get(game, ())}
+        )
+
+    async def remove_game(self, guild, game):
+        index = await self._index(guild)
+        index.remove_game(game)
+        await self.config.custom("GAME", str(guild.id), game).clear()
+        await self.config.custom("SUBSCRIBER", str(guild.id), game).clear()
@@ -0,0 +1,127 @@
+"""Exercise each cog's HTTPClient against a local aiohttp stub server.
+
+The cog packages import Red on import, so the client modules are loaded straight
+from their files."""
+import asyncio
+import importlib.util
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_client(cog):
+    spec = importlib.util.spec_from_file_location(f"{cog}_http", ROOT / cog / "http.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=["autotimetable", "verify"])
+def http(request):
+    return load_client(request.param)
+
+
+async def serve(routes):
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def run_against(http, routes, requests, **client_kwargs):
+    async def main():
+        runner, base_url = await serve(routes)
+        client = http.HTTPClient(base_url=base_url, backoff=0.01, **client_kwargs)
+        try:
+            return [await request(client) for request in requests], client
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+def test_decodes_json(http):
+    async def handler(request):
+        return web.json_response({"course": request.match_info["email"]})
+
+    (resp,), client = run_against(
+        http,
+        [web.get("/api/v1/course/{email}", handler)],
+        [lambda client: client.request_json("GET", "/api/v1/course/a@mail.dcu.ie", endpoint="course")],
+    )
+    assert resp == http.HTTPResponse(200, {"course": "a@mail.dcu.ie"})
+    assert client.latencies["course"].count == 1
+    assert client.latencies["course"].errors == 0
+
+
+def test_retries_server_errors(http):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.path)
+        if len(calls) < 3:
+            return web.Response(status=503)
+        return web.json_response([1, 2])
+
+    (resp,), client = run_against(
+        http, [web.post("/events", handler)], [lambda client: client.request_json("POST", "/events", json={})]
+    )
+    assert resp == http.HTTPResponse(200, [1, 2])
+    assert len(calls) == 3
+    assert client.latencies["/events"].errors == 2
+
+
+def test_gives_up_on_persistent_server_errors(http):
+    async def handler(request):
+        return web.Response(status=500)
+
+    (resp,), _ = run_against(
+        http, [web.get("/down", handler)], [lambda client: client.request_json("GET", "/down")], retries=2
+    )
+    assert resp == http.HTTPResponse(500, None)
+
+
+def test_non_200_and_bad_bodies_have_no_data(http):
+    async def missing(request):
+        return web.Response(status=404)
+
+    async def garbage(request):
+        return web.Response(text="not json")
+
+    (missing_resp, garbage_resp), _ = run_against(
+        http,
+        [web.get("/missing", missing), web.get("/garbage", garbage)],
+        [
+            lambda client: client.request_json("GET", "/missing"),
+            lambda client: client.request_json("GET", "/garbage"),
+        ],
+    )
+    assert missing_resp == http.HTTPResponse(404, None)
+    assert garbage_resp == http.HTTPResponse(200, None)
+
+
+def test_timeouts_are_raised_after_retries(http):
+    calls = []
+
+    async def slow(request):
+        calls.append(request.path)
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    with pytest.raises(asyncio.TimeoutError):
+        run_against(
+            http,
+            [web.get("/slow", slow)],
+            [lambda client: client.request_json("GET", "/slow")],
+            retries=1,
+            total_timeout=0.1,
+        )
+    assert len(calls) == 2
@@ -0,0 +1,128 @@
+"""Exercise verify's Mailer against a local aiosmtpd stub server.
+
+The verify package imports Red on import, so the mailer module is loaded straight
+from its file."""
+import asyncio
+import importlib.util
+import time
+from email.message import EmailMessage
+from pathlib import Path
+
+from aiosmtpd.smtp import SMTP
+
+ROOT = Path(__file__).resolve().parent.parent
+
+spec = importlib.util.spec_from_file_location("verify_mailer", ROOT / "verify" / "mailer.py")
+mailer = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mailer)
+
+
+class Handler:
+    """Records every delivery and the connection it arrived on.
+
+    The first ``failures`` deliveries are rejected with a transient error."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.connections = 0
+        self.quits = 0
+        self.deliveries = []
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.failures:
+            self.failures -= 1
+            return "451 Try again later"
+        self.deliveries.append((self.connections, envelope.rcpt_tos, time.monotonic()))
+        return "250 OK"
+
+    async def handle_QUIT(self, server, session, envelope):
+        self.quits += 1
+        return "221 Bye"
+
+
+async def serve(handler):
+    def connect():
+        handler.connections += 1
+        return SMTP(handler, hostname="localhost")
+
+    server = await asyncio.get_running_loop().create_server(connect, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def message(to):
+    msg = EmailMessage()
+    msg["From"] = "bot@example.com"
+    msg["To"] = to
+    msg["Subject"] = "Verification code"
+    msg.set_content("123456")
+    return msg
+
+
+async def no_credentials():
+    return None, None
+
+
+def send_all(handler, batches, pause=0, **mailer_kwargs):
+    """Send each batch of recipients, waiting for the queue to drain and ``pause``
+    seconds between batches."""
+
+    async def main():
+        server, port = await serve(handler)
+        client = mailer.Mailer(
+            no_credentials, hostname="127.0.0.1", port=port, use_tls=False, **{"interval": 0, **mailer_kwargs}
+        )
+        try:
+            for number, batch in enumerate(batches):
+                if number:
+                    await asyncio.sleep(pause)
+                for to in batch:
+                    client.enqueue(message(to))
+                await asyncio.wait_for(client.queue.join(), timeout=5)
+            return client
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(main())
+
+
+def test_reuses_one_connection():
+    handler = Handler()
+    client = send_all(handler, [["a@mail.dcu.ie", "b@mail.dcu.ie", "c@mail.dcu.ie"]])
+    assert [rcpt for _, rcpt, _ in handler.deliveries] == [["a@mail.dcu.ie"], ["b@mail.dcu.ie"], ["c@mail.dcu.ie"]]
+    assert handler.connections == 1
+    assert client.sent == 3
+
+
+def test_reconnects_after_idling():
+    handler = Handler()
+    client = send_all(handler, [["a@mail.dcu.ie"], ["b@mail.dcu.ie"]], pause=0.3, idle_timeout=0.1)
+    assert [connection for connection, _, _ in handler.deliveries] == [1, 2]
+    assert handler.quits >= 1
+    assert client.sent == 2
+
+
+def test_spaces_sends_by_interval():
+    handler = Handler()
+    send_all(handler, [["a@mail.dcu.ie", "b@mail.dcu.ie", "c@mail.dcu.ie"]], interval=0.2)
+    times = [sent_at for _, _, sent_at in handler.deliveries]
+    assert len(times) == 3
+    assert all(later - earlier >= 0.19 for earlier, later in zip(times, times[1:]))
+
+
+def test_retries_with_a_fresh_connection():
+    handler = Handler(failures=1)
+    client = send_all(handler, [["a@mail.dcu.ie"]], backoff=0.01)
+    assert [connection for connection, _, _ in handler.deliveries] == [2]
+    assert client.sent == 1
+    assert client.failed == 0
+
+
+def test_gives_up_after_retries():
+    handler = Handler(failures=10)
+    client = send_all(handler, [["a@mail.dcu.ie"]], retries=2, backoff=0.01)
+    assert handler.deliveries == []
+    assert handler.connections == 3
+    assert client.sent == 0
+    assert client.failed == 1
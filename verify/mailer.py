@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+
+import aiosmtplib
+
+log = logging.getLogger("red.flare.verify.mailer")
+
+
+class Mailer:
+    """A background queue that sends mail over one persistent SMTP connection.
+
+    The connection is authenticated once, reused across messages and dropped after
+    ``idle_timeout`` seconds without mail. Sends are spaced at least ``interval``
+    seconds apart to stay under provider quotas, and failures are retried with a
+    fresh connection. ``credentials`` is a coroutine function returning a
+    ``(username, password)`` tuple."""
+
+    def __init__(
+        self,
+        credentials,
+        *,
+        hostname="smtp.gmail.com",
+        port=465,
+        use_tls=True,
+        interval=1.0,
+        idle_timeout=60,
+        retries=3,
+        backoff=5,
+    ):
+        self.credentials = credentials
+        self.hostname = hostname
+        self.port = port
+        self.use_tls = use_tls
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = asyncio.Queue()
+        self.sent = 0
+        self.failed = 0
+        self._smtp = None
+        self._worker = None
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+        await self._disconnect()
+
+    async def reset(self):
+        """Drop the current connection so the next message logs in again."""
+        await self._disconnect()
+
+    def enqueue(self, message):
+        """Queue a message for sending and return immediately."""
+        self.start()
+        self.queue.put_nowait(message)
+
+    async def _connect(self):
+        if self._smtp is not None and self._smtp.is_connected:
+            return self._smtp
+        smtp = aiosmtplib.SMTP(hostname=self.hostname, port=self.port, use_tls=self.use_tls)
+        await smtp.connect()
+        username, password = await self.credentials()
+        if username is not None:
+            await smtp.login(username, password)
+        self._smtp = smtp
+        return smtp
+
+    async def _disconnect(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None and smtp.is_connected:
+            try:
+                await smtp.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                smtp.close()
+
+    async def _run(self):
+        last_sent = 0.0
+        while True:
+            try:
+                message = await asyncio.wait_for(self.queue.get(), timeout=self.idle_timeout)
+            except asyncio.TimeoutError:
+                await self._disconnect()
+                continue
+            await asyncio.sleep(max(0.0, last_sent + self.interval - time.monotonic()))
+            try:
+                await self._send(message)
+            finally:
+                last_sent = time.monotonic()
+                self.queue.task_done()
+
+    async def _send(self, message):
+        for attempt in range(self.retries + 1):
+            try:
+                smtp = await self._connect()
+                await smtp.send_message(message)
+            except (aiosmtplib.SMTPException, OSError):
+                await self._disconnect()
+                if attempt == self.retries:
+                    self.failed += 1
+                    log.exception("Failed to send mail to %s", message["To"])
+                    return
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            else:
+                self.sent += 1
+                return
+
+    def __str__(self):
+        return f"{self.queue.qsize()} queued, {self.sent} sent, {self.failed} failed"
@@ -1,21 +1,83 @@
 import asyncio
+import contextvars
+import inspect
 from datetime import datetime
 
 from pytz.exceptions import Error
 import aiohttp
 import json
+import logging
 import random
 import secrets
+import time
+from collections import Counter, OrderedDict
 from email.message import EmailMessage
 
-import aiosmtplib
 import discord
 from redbot.core import Config, commands
+from redbot.core.config import Value
 from redbot.core.data_manager import bundled_data_path, cog_data_path
-from redbot.core.utils.chat_formatting import pagify
+from redbot.core.utils.chat_formatting import box, pagify
 from redbot.core.utils.menus import DEFAULT_CONTROLS, menu
 from redbot.core.utils.predicates import MessagePredicate
 
+from .http import HTTPClient
+from .mailer import Mailer
+
+log = logging.getLogger("red.flare.verify")
+
+RECHECK_CONCURRENCY = 10
+RECHECK_EDIT_CONCURRENCY = 3
+GUILD_ID = 713522800081764392
+
+ROLE_IDS = {
+    "external": 713538609017258025,
+    "visitor": 871146938525974569,
+    "verified": 713538570824187968,
+    "case4": 713541403904442438,
+    "case3": 713539660936118282,
+    "case2": 713538655817564250,
+    "ca": 713541535085494312,
+    "case": 713538335984975943,
+    "alumni": 713538175456247828,
+}
+
+# SoC API course code -> roles granted for it.
+COURSE_ROLES = {
+    "COMSCI1": ("ca", "case"),
+    "COMSCI2": ("case2", "case"),
+    "CASE3": ("case3", "case"),
+    "CASE4": ("case4", "case"),
+    "CASE": ("alumni", "case"),
+}
+
+USER_DEFAULTS = {
+    "code": None,
+    "code_created": None,
+    "verified": False,
+    "email": None,
+    "verified_by": None,
+    "last_checked": None,
+}
+# Fields reset once a pending verification is finished or abandoned.
+PENDING_CLEARED = {"code": None, "code_created": None}
+
+
+
+def strip_defaults(data, defaults=USER_DEFAULTS):
+    """Drop the keys of a record that just repeat their registered default."""
+    return {key: value for key, value in data.items() if key not in defaults or defaults[key] != value}
+
+
+# verify user <type> -> roles granted.
+MANUAL_ROLES = {
+    "external": ("external", "verified"),
+    "internal": ("verified",),
+    "alumni": ("alumni",),
+}
+
+current_command = contextvars.ContextVar("current_command", default="background")
+
 
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
@@ -23,56 +85,531 @@ def chunks(l, n):
         yield l[i : i + n]
 
 
+class CourseCache:
+    """An LRU of email -> SoC API course lookups persisted to a JSON file.
+
+    Failed lookups are cached separately with a much shorter TTL."""
+
+    MISSING = object()
+
+    def __init__(self, path, *, maxsize=5000, ttl=7 * 24 * 60 * 60, negative_ttl=60 * 60):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.entries = OrderedDict()
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entries = []
+        now = time.time()
+        for email, expires, value in entries[-maxsize:]:
+            if expires > now:
+                self.entries[email] = (expires, value)
+
+    def get(self, email):
+        entry = self.entries.get(email)
+        if entry is None or entry[0] <= time.time():
+            self.misses += 1
+            return self.MISSING
+        self.entries.move_to_end(email)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, email, value):
+        ttl = self.ttl if isinstance(value, dict) else self.negative_ttl
+        self.entries[email] = (time.time() + ttl, value)
+        self.entries.move_to_end(email)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def invalidate(self, email=None):
+        """Drop one email, or everything if none is given. Returns how many entries were removed."""
+        if email is None:
+            removed = len(self.entries)
+            self.entries.clear()
+        else:
+            removed = int(self.entries.pop(email, None) is not None)
+        self.dirty = True
+        return removed
+
+    def save(self):
+        if not self.dirty:
+            return
+        with open(self.path, "w") as f:
+            json.dump([[email, *entry] for email, entry in self.entries.items()], f)
+        self.dirty = False
+
+    def __str__(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"{len(self.entries)} cached, {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate)"
+
+
+class CountingConfig:
+    """Proxy around a Config (and the groups and values reached through it).
+
+    ``count`` is called once for every call that touches storage, i.e. each call that
+    returns an awaitable, so no call site has to remember to count itself."""
+
+    __slots__ = ("_target", "_count")
+
+    def __init__(self, target, count):
+        self._target = target
+        self._count = count
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if isinstance(attr, Value) or inspect.ismethod(attr):
+            return CountingConfig(attr, self._count)
+        return attr
+
+    def __call__(self, *args, **kwargs):
+        result = self._target(*args, **kwargs)
+        if inspect.isawaitable(result):
+            self._count()
+        elif isinstance(result, Value):
+            return CountingConfig(result, self._count)
+        return result
+
+
+class RoleResolver:
+    """Resolves SoC course codes to the role IDs they grant."""
+
+    def __init__(self, course_roles, role_ids):
+        self.course_roles = {
+            course: frozenset(role_ids[name] for name in names) for course, names in course_roles.items()
+        }
+        self.managed = frozenset().union(*self.course_roles.values())
+
+    def roles_for(self, course):
+        """Return the role IDs for a course, or an empty frozenset if it isn't known."""
+        return self.course_roles.get(course, frozenset())
+
+    def diff(self, roles, course):
+        """Return the ``(add, remove)`` role ID sets to move ``roles`` onto ``course``.
+
+        Unknown courses never remove roles."""
+        desired = self.roles_for(course)
+        if not desired:
+            return frozenset(), frozenset()
+        current = {role.id for role in roles}
+        return desired - current, (current & self.managed) - desired
+
+
+class Settings:
+    """An in-memory snapshot of Verify's global settings.
+
+    Reloaded whenever a command changes them, so the verification path never reads Config."""
+
+    __slots__ = ("welcome_messages", "username", "password", "headers", "roles", "code_ttl")
+
+    def __init__(self):
+        self.welcome_messages = ()
+        self.username = self.password = None
+        self.headers = {}
+        self.roles = {}
+        self.code_ttl = 24 * 60 * 60
+
+    async def load(self, bot, config):
+        data = await config.all()
+        self.welcome_messages = tuple(data["welcome_messages"])
+        self.username, self.password = data["username"], data["password"]
+        self.code_ttl = data["code_ttl"]
+        self.set_tokens(await bot.get_shared_api_tokens("CASE"))
+        self.set_roles(bot.get_guild(GUILD_ID))
+
+    def set_roles(self, guild):
+        """Resolve ``ROLE_IDS`` to role objects; a missing guild or role maps to None."""
+        self.roles = {
+            name: guild.get_role(role_id) if guild is not None else None for name, role_id in ROLE_IDS.items()
+        }
+
+    def set_tokens(self, tokens):
+        self.headers = {"x-api-key": tokens.get("SOC_API_TOKEN")}
+
+
 class Verify(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
-        self.config = Config.get_conf(self, identifier=95932766180343808, force_registration=True)
+        self.http = HTTPClient(base_url="https://ws.computing.dcu.ie")
+        self.config_calls = Counter()
+        self.config = CountingConfig(
+            Config.get_conf(self, identifier=95932766180343808, force_registration=True), self.count_config_call
+        )
         self.config.register_global(
-            username=None, password=None, verified_emails=[], welcome_messages=[]
+            username=None,
+            password=None,
+            verified_emails=[],
+            welcome_messages=[],
+            schema_version=0,
+            reconcile_slice=25,
+            reconcile_edits=10,
+            reconcile_interval=60 * 60,
+            reconcile_cursor={},
+            code_ttl=24 * 60 * 60,
+            compaction_interval=24 * 60 * 60,
+            last_compaction={},
         )
-        self.config.register_user(code=None, verified=False, email=None, verified_by=None)
+        self.config.register_user(**USER_DEFAULTS)
+        self.config.init_custom("EMAIL", 1)
+        self.config.register_custom("EMAIL", verified=False, user_id=None)
+        self.course_cache = CourseCache(cog_data_path(self) / "course_cache.json")
+        self.settings = Settings()
+        self.mailer = Mailer(self.smtp_credentials)
+        self.command_uses = Counter()
         self._init_task = self.bot.loop.create_task(self.initialize())
+        self._cache_task = self.bot.loop.create_task(self.persist_course_cache())
+        self._compaction_task = self.bot.loop.create_task(self.compaction_loop())
+        self.reconcile_pending = set()
+        self.reconcile_deferred = set()
+        self._reconcile_wake = asyncio.Event()
+        self._reconcile_task = self.bot.loop.create_task(self.reconcile_loop())
 
     async def initialize(self):
         """This will load all the bundled data into respective variables."""
         await self.bot.wait_until_red_ready()
-        guild = self.bot.get_guild(713522800081764392)
-        self.roles = {
-            "external": guild.get_role(713538609017258025),
-            "visitor": guild.get_role(871146938525974569),
-            "verified": guild.get_role(713538570824187968),
-            "case4": guild.get_role(713541403904442438),
-            "case3": guild.get_role(713539660936118282),
-            "case2": guild.get_role(713538655817564250),
-            "ca": guild.get_role(713541535085494312),
-            "case": guild.get_role(713538335984975943),
-            "alumni": guild.get_role(713538175456247828),
-        }
-        tokens = await self.bot.get_shared_api_tokens("CASE")
-        self.ReqHeaders = {
-            "x-api-key": tokens.get("SOC_API_TOKEN")
+        await self.migrate_verified_emails()
+        await self.refresh_settings()
+        self.resolver = RoleResolver(COURSE_ROLES, ROLE_IDS)
+
+    async def refresh_settings(self):
+        await self.settings.load(self.bot, self.config)
+
+    @commands.Cog.listener()
+    async def on_red_api_tokens_update(self, service_name, api_tokens):
+        if service_name == "CASE":
+            self.settings.set_tokens(api_tokens)
+
+    @commands.Cog.listener("on_guild_role_create")
+    @commands.Cog.listener("on_guild_role_delete")
+    async def on_guild_role_change(self, role):
+        if role.guild.id == GUILD_ID and role.id in ROLE_IDS.values():
+            self.settings.set_roles(role.guild)
+
+    async def cog_before_invoke(self, ctx):
+        current_command.set(ctx.command.qualified_name)
+        self.command_uses[ctx.command.qualified_name] += 1
+
+    def count_config_call(self):
+        self.config_calls[current_command.get()] += 1
+
+    async def read_user(self, user):
+        """Read a user's whole record in one Config call."""
+        return await self.config.user(user).all()
+
+    async def write_user(self, user, data):
+        """Replace a user's whole record in one Config call, storing only non-default fields."""
+        await self.config.user(user).set(strip_defaults(data))
+
+    async def clear_user(self, user):
+        """Drop a user's whole record, resetting it to the defaults."""
+        await self.config.user(user).clear()
+
+    async def sync_course_roles(self, member, course, *, reason):
+        """Move a member onto a course's roles with at most one edit.
+
+        Returns True if the member's roles changed."""
+        add, remove = self.resolver.diff(member.roles, course)
+        if not add and not remove:
+            return False
+        roles = [role for role in member.roles if role.id not in remove and not role.is_default()]
+        roles.extend(role for role in map(member.guild.get_role, add) if role is not None)
+        await member.edit(roles=roles, reason=reason)
+        return True
+
+    def course_role_names(self, guild, course):
+        return ", ".join(
+            role.name for role in map(guild.get_role, self.resolver.roles_for(course)) if role is not None
+        )
+
+    async def migrate_verified_emails(self):
+        """Move the old global verified_emails list into the per-email custom group."""
+        if await self.config.schema_version() >= 1:
+            return
+        emails = await self.config.verified_emails()
+        owners = {
+            self.normalise_email(data["email"]): user_id
+            for user_id, data in (await self.config.all_users()).items()
+            if data.get("verified") and data.get("email")
         }
+        # One write for the whole group; a set per email would rewrite the JSON file each time.
+        entries = await self.config.custom("EMAIL").all()
+        for email in map(self.normalise_email, emails):
+            entries[email] = {"verified": True, "user_id": owners.get(email)}
+        await self.config.custom("EMAIL").set(entries)
+        await self.config.verified_emails.clear()
+        await self.config.schema_version.set(1)
+        log.info("Migrated %s verified emails", len(emails))
+
+    @staticmethod
+    def normalise_email(email):
+        return email.strip().lower()
+
+    async def is_email_verified(self, email):
+        return await self.config.custom("EMAIL", self.normalise_email(email)).verified()
 
-    async def get_course_year(self, email):
+    async def add_verified_email(self, email, user_id):
+        await self.config.custom("EMAIL", self.normalise_email(email)).set({"verified": True, "user_id": user_id})
+
+    async def remove_verified_email(self, email):
+        await self.config.custom("EMAIL", self.normalise_email(email)).clear()
+
+    async def get_course_year(self, email, *, refresh=False):
         """Fetch a user's course year via the SoC API"""
-        async with self.session.get(
-            f"https://ws.computing.dcu.ie/api/v1/course/{email}",
-            headers=self.ReqHeaders,
-        ) as req:
-            if req.status != 200:
-                return
+        email = email.lower()
+        if not refresh:
+            cached = self.course_cache.get(email)
+            if cached is not CourseCache.MISSING:
+                return cached
+        try:
+            resp = await self.http.request_json(
+                "GET",
+                f"/api/v1/course/{email}",
+                endpoint="soc course",
+                headers=self.settings.headers,
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            return
+        if resp.status >= 500:
+            return
+        if resp.status != 200:
+            result = None
+        elif resp.data is None:
+            result = False
+        else:
+            result = resp.data
+        self.course_cache.set(email, result)
+        return result
+
+    async def persist_course_cache(self):
+        while True:
+            await asyncio.sleep(300)
+            self.course_cache.save()
+
+    async def reconcile_loop(self):
+        """Recheck verified members' course roles a slice at a time, oldest check first.
+
+        A full pass is spread over the interval between slices rather than done in one burst.
+        Member joins and managed role changes queue an early, pending-only slice."""
+        await self._init_task
+        while True:
+            interval = await self.config.reconcile_interval()
+            cursor = await self.config.reconcile_cursor()
+            delay = cursor.get("last_run", 0) + interval - time.time()
             try:
-                resp = (await req.json())
-            except Exception as e:
-                return False
-            return resp
+                await asyncio.wait_for(self._reconcile_wake.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                scheduled = True
+            else:
+                scheduled = False
+                # Let a burst of joins/updates settle into one slice.
+                await asyncio.sleep(5)
+            self._reconcile_wake.clear()
+            try:
+                await self.reconcile_slice(scheduled=scheduled)
+            except Exception:
+                log.exception("Role reconciliation slice failed")
+                if scheduled:
+                    # Don't retry a failing slice in a tight loop.
+                    await self.config.reconcile_cursor.set({**cursor, "last_run": time.time()})
+
+    async def reconcile_slice(self, *, scheduled=True):
+        """Recheck queued members, then (if scheduled) the members checked longest ago.
+
+        At most ``reconcile_slice`` SoC API lookups and ``reconcile_edits`` role edits are made.
+        Queued members that don't fit in either budget, or whose lookup failed, are deferred to
+        the next scheduled slice; unqueued ones simply stay the oldest checked.
+        Returns ``(checked, edited)``."""
+        guild = self.bot.get_guild(GUILD_ID)
+        if guild is None:
+            return 0, 0
+        limit = await self.config.reconcile_slice()
+        edit_budget = await self.config.reconcile_edits()
+        users = await self.config.all_users()
+
+        def due(user_id):
+            data = users.get(user_id, {})
+            member = guild.get_member(user_id)
+            if member is None or not data.get("verified") or "@" not in (data.get("email") or ""):
+                return None
+            return member
+
+        pending, self.reconcile_pending = self.reconcile_pending, set()
+        if scheduled:
+            pending |= self.reconcile_deferred
+            self.reconcile_deferred = set()
+        batch = [member for member in map(due, pending) if member is not None][:limit]
+        queued = {member.id for member in batch}
+        if scheduled:
+            oldest = sorted(
+                (data.get("last_checked") or 0, user_id)
+                for user_id, data in users.items()
+                if user_id not in queued and due(user_id) is not None
+            )
+            batch.extend(guild.get_member(user_id) for _, user_id in oldest[: limit - len(batch)])
+        self.reconcile_deferred |= {
+            user_id for user_id in pending if user_id not in queued and due(user_id) is not None
+        }
+
+        sem = asyncio.Semaphore(RECHECK_CONCURRENCY)
+
+        async def lookup(member):
+            async with sem:
+                return await self.get_course_year(
+                    users[member.id]["email"].lower(), refresh=scheduled and member.id not in queued
+                )
+
+        results = await asyncio.gather(*map(lookup, batch), return_exceptions=True)
+        now = time.time()
+        checked = edited = 0
+        for member, user_year in zip(batch, results):
+            if isinstance(user_year, Exception) or user_year is None:
+                if isinstance(user_year, Exception):
+                    log.error("Failed to look up %s", member, exc_info=user_year)
+                # Retry later without marking the member checked.
+                if member.id in queued:
+                    self.reconcile_deferred.add(member.id)
+                continue
+            if type(user_year) == dict:
+                course = user_year["course"]
+                add, remove = self.resolver.diff(member.roles, course)
+                if add or remove:
+                    if edited >= edit_budget:
+                        if member.id in queued:
+                            self.reconcile_deferred.add(member.id)
+                        continue
+                    try:
+                        await self.sync_course_roles(member, course, reason="Role reconciliation")
+                    except discord.HTTPException:
+                        log.exception("Failed to update roles for %s", member)
+                        continue
+                    edited += 1
+                    log.info("Updated %s's roles - New roles: %s", member, self.course_role_names(guild, course))
+            await self.config.user_from_id(member.id).last_checked.set(now)
+            checked += 1
+
+        if scheduled:
+            cursor = await self.config.reconcile_cursor()
+            eligible = sum(1 for user_id in users if due(user_id) is not None)
+            sweep_checked = cursor.get("sweep_checked", 0) + checked
+            if sweep_checked >= eligible:
+                sweep_checked = 0
+                cursor["sweeps"] = cursor.get("sweeps", 0) + 1
+            await self.config.reconcile_cursor.set(
+                {**cursor, "last_run": now, "sweep_checked": sweep_checked, "eligible": eligible}
+            )
+        return checked, edited
+
+    def queue_reconcile(self, member):
+        if member.guild.id != GUILD_ID or member.bot:
+            return
+        self.reconcile_pending.add(member.id)
+        self._reconcile_wake.set()
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self.queue_reconcile(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if not hasattr(self, "resolver"):
+            return
+        managed = self.resolver.managed
+        if {role.id for role in before.roles} & managed != {role.id for role in after.roles} & managed:
+            self.queue_reconcile(after)
+
+    @staticmethod
+    def code_expired(data, ttl, now=None):
+        """Whether a pending code is past its TTL. Codes from before timestamps were kept count as expired."""
+        created = data.get("code_created")
+        return created is None or created + ttl <= (now or time.time())
+
+    async def compaction_loop(self):
+        # The code TTL comes from the settings snapshot, which initialize loads.
+        await self._init_task
+        while True:
+            interval = await self.config.compaction_interval()
+            last = (await self.config.last_compaction()).get("at", 0)
+            await asyncio.sleep(max(last + interval - time.time(), 0))
+            try:
+                await self.compact_users()
+            except Exception:
+                log.exception("User record compaction failed")
+                await self.config.last_compaction.set({"at": time.time()})
+
+    def compaction_plan(self, data, ttl, now, *, strip_all=False):
+        """Decide what compaction does to one user record.
+
+        Returns None to leave it alone, ``True`` to purge it, or the fields to clear:
+        leftover pending fields, plus every default-valued field when ``strip_all``."""
+        if not data.get("verified"):
+            if data.get("code") is not None and not self.code_expired(data, ttl, now):
+                return None
+            return True
+        if strip_all:
+            fields = [key for key, default in USER_DEFAULTS.items() if data.get(key, default) == default]
+            fields += [key for key in PENDING_CLEARED if key not in fields]
+        else:
+            fields = [key for key in PENDING_CLEARED if data.get(key) is not None]
+        return fields or None
+
+    async def compact_users(self):
+        """Drop finished or expired codes and purge records of unverified users with nothing pending.
+
+        The first pass also clears the default-valued fields of every verified record, which
+        older versions of ``write_user`` stored in full. Records are re-read just before they
+        are changed and only the trimmed fields are cleared, so commands running during the
+        pass don't lose their writes.
+        Returns stats including how many records were purged or trimmed and a lower bound on
+        the bytes that reclaimed, measured as the JSON size of the records' non-default fields."""
+        users = await self.config.all_users()
+        strip_all = await self.config.schema_version() < 2
+        ttl = self.settings.code_ttl
+        now = time.time()
+        purged = trimmed = reclaimed = 0
+        for user_id, data in users.items():
+            if self.compaction_plan(data, ttl, now, strip_all=strip_all) is None:
+                continue
+            group = self.config.user_from_id(user_id)
+            data = await group.all()
+            plan = self.compaction_plan(data, ttl, now, strip_all=strip_all)
+            if plan is None:
+                continue
+            before = len(json.dumps(strip_defaults(data)))
+            if plan is True:
+                await group.clear()
+                purged += 1
+                reclaimed += before
+                continue
+            for key in plan:
+                await group.get_attr(key).clear()
+            trimmed += 1
+            after = {**data, **{key: USER_DEFAULTS[key] for key in plan}}
+            reclaimed += before - len(json.dumps(strip_defaults(after)))
+        if strip_all:
+            await self.config.schema_version.set(2)
+        stats = {"at": now, "purged": purged, "trimmed": trimmed, "bytes": reclaimed}
+        await self.config.last_compaction.set(stats)
+        log.info(
+            "Compacted user records: %s purged, %s trimmed, at least %s bytes reclaimed", purged, trimmed, reclaimed
+        )
+        return stats
 
     def cog_unload(self):
         if self._init_task:
             self._init_task.cancel()
-        self.bot.loop.create_task(self.session.close())
-        self.loop.cancel()
+        self._cache_task.cancel()
+        self._compaction_task.cancel()
+        self._reconcile_task.cancel()
+        self.bot.loop.create_task(self.mailer.close())
+        self.course_cache.save()
+        self.bot.loop.create_task(self.http.close())
 
     @commands.group()
     async def verify(self, ctx):
@@ -88,31 +625,25 @@ class Verify(commands.Cog):
     async def unverify_self(self, ctx):
         """Unverify yourself"""
         user = ctx.message.author
-        data = await self.config.user(user).all()
+        data = await self.read_user(user)
         if not data["verified"]:
             return await ctx.send("You are already not verified.")
-        async with self.config.verified_emails() as emails:
-            if data["email"] in emails:
-                emails.remove(data["email"])
-        await self.config.user(user).code.set(None)
-        await self.config.user(user).verified.set(False)
-        await self.config.user(user).email.set(None)
-        await user.remove_roles(*self.roles.values(), reason="Removed for unverification.")
+        if data["email"]:
+            await self.remove_verified_email(data["email"])
+        await self.clear_user(user)
+        await user.remove_roles(*filter(None, self.settings.roles.values()), reason="Removed for unverification.")
         await user.send("You have been un-verified. To re-verify use the `.verify email your_dcu_email_here` command or contact an Admin.")
 
     @unverify.command(name="user")
     @commands.admin()
     async def unverify_user(self, ctx, *, user: discord.User):
         """Unverify someone"""
-        data = await self.config.user(user).all()
+        data = await self.read_user(user)
         if not data["verified"]:
             return await ctx.send("This user isn't verified.")
-        async with self.config.verified_emails() as emails:
-            if data["email"] in emails:
-                emails.remove(data["email"])
-        await self.config.user(user).code.set(None)
-        await self.config.user(user).verified.set(False)
-        await self.config.user(user).email.set(None)
+        if data["email"]:
+            await self.remove_verified_email(data["email"])
+        await self.clear_user(user)
         await ctx.send("User has been un-verified.")
 
     @verify.command(name="email")
@@ -128,19 +659,18 @@ class Verify(commands.Cog):
             )
         if not email.lower().endswith("@mail.dcu.ie"):
             return await ctx.send("This doesn't seem to be a valid DCU email.")
-        if await self.config.user(ctx.author).verified():
+        data = await self.read_user(ctx.author)
+        if data["verified"]:
             await ctx.send("You have already been verified.")
             await (self.bot.get_channel(713522800081764395)).send(
                 f"{ctx.author} with the email {email} has tried to verify with an email that has already been verified."
             )
             return
-        emails = await self.config.verified_emails()
-        if email in emails:
+        if await self.is_email_verified(email):
             await ctx.send("This email has already been verified.")
             return
         code = secrets.token_hex(3)
-        await self.config.user(ctx.author).code.set(code)
-        await self.config.user(ctx.author).email.set(email)
+        await self.write_user(ctx.author, {**data, "code": code, "code_created": time.time(), "email": email})
         await self.send_email(email, code)
         await ctx.send(
             f"You will recieve an email shortly. Once it arrived you may complete your verification process by typing:\n{ctx.clean_prefix}verify code <code from email>"
@@ -150,9 +680,9 @@ class Verify(commands.Cog):
     @commands.dm_only()
     async def verify_code(self, ctx, code):
         """Verify the code from your email"""
-        usercode = await self.config.user(ctx.author).code()
-        verified = await self.config.user(ctx.author).verified()
-        if verified:
+        data = await self.read_user(ctx.author)
+        usercode = data["code"]
+        if data["verified"]:
             await ctx.send("You are already verified.")
             return
         if usercode is None:
@@ -160,24 +690,30 @@ class Verify(commands.Cog):
                 "You haven't started the verification process yet. Get started by invoking the .verify email command."
             )
             return
+        if self.code_expired(data, self.settings.code_ttl):
+            await self.write_user(ctx.author, {**data, **PENDING_CLEARED, "email": None})
+            await ctx.send(
+                "That code has expired. Request a new one with the .verify email command."
+            )
+            return
         if code == usercode:
             roles = []
-            verified = await self.config.user(ctx.author).verified.set(True)
-            await self.config.user(ctx.author).verified_by.set("System")
-            email = await self.config.user(ctx.author).email()
-            async with self.config.verified_emails() as emails:
-                emails.append(email)
-            guild = self.bot.get_guild(713522800081764392)
-            role = guild.get_role(713538570824187968)
+            email = data["email"]
+            await self.write_user(
+                ctx.author, {**data, **PENDING_CLEARED, "verified": True, "verified_by": "System"}
+            )
+            await self.add_verified_email(email, ctx.author.id)
+            guild = self.bot.get_guild(GUILD_ID)
+            role = self.settings.roles["verified"]
             user = guild.get_member(ctx.author.id)
             mod, general = self.bot.get_channel(713522800081764395), self.bot.get_channel(
                 713524886840279042
             )
-            greeting_msgs = await self.config.welcome_messages()
+            greeting_msgs = self.settings.welcome_messages
 
             # Set user nickname to real name if not already there
 
-            user_email = await self.config.user(ctx.author).email()
+            user_email = email
             first_name = user_email.split(".")[0]
             name_len = 32 - len(f" ({first_name})")
             name = user.display_name[:name_len] + f" ({first_name.title()})"
@@ -193,27 +729,13 @@ class Verify(commands.Cog):
             
             if type(user_year) != dict:
                 rolemsg = "We were unable to determine your year of study. Please contact an admin to have a year role assigned to you."
-            else:
-                if user_year['course'] == "COMSCI1":
-                    rolemsg = "We've automatically determined you as a COMSCI1 student. If this is an error, you can correct this by contacting an admin."
-                    roles.append(self.roles["ca"])
-                    roles.append(self.roles["case"])
-                elif user_year['course'] == "COMSCI2":
-                    rolemsg = "We've automatically determined you as a COMSCI2 student. If this is an error, you can correct this by contacting an admin."
-                    roles.append(self.roles["case2"])
-                    roles.append(self.roles["case"])
-                elif user_year['course'] == "CASE3":
-                    rolemsg = "We've automatically determined you as a CASE3 student. If this is an error, you can correct this by contacting an admin."
-                    roles.append(self.roles["case3"])
-                    roles.append(self.roles["case"])
-                elif user_year['course'] == "CASE4":
-                    rolemsg = "We've automatically determined you as a CASE4 student. If this is an error, you can correct this by contacting an admin."
-                    roles.append(self.roles["case4"])
-                    roles.append(self.roles["case"])
-                elif user_year['course'] == "CASE":
+            elif self.resolver.roles_for(user_year['course']):
+                course = user_year['course']
+                if course == "CASE":
                     rolemsg = "We've automatically determined you as an Alumni. If this is an error, you can correct this by contacting an admin."
-                    roles.append(self.roles["alumni"])
-                    roles.append(self.roles["case"])
+                else:
+                    rolemsg = f"We've automatically determined you as a {course} student. If this is an error, you can correct this by contacting an admin."
+                roles.extend(filter(None, map(guild.get_role, self.resolver.roles_for(course))))
 
             # Add roles and greet
 
@@ -239,8 +761,7 @@ class Verify(commands.Cog):
     @commands.dm_only()
     async def verify_other(self, ctx, *, message: str):
         """Verification process for external/alumni members."""
-        verified = await self.config.user(ctx.author).verified()
-        if verified:
+        if (await self.read_user(ctx.author))["verified"]:
             await ctx.send("You are already verified.")
             return
         guild = self.bot.get_guild(713522800081764392)
@@ -255,24 +776,19 @@ class Verify(commands.Cog):
     async def user(self, ctx, type: str, *, user: discord.Member):
         """Verify a user.
         Valid types are internal, external and alumni."""
-        if ctx.guild.id != 713522800081764392:
+        if ctx.guild.id != GUILD_ID:
             await ctx.send("This must be used in the CASE++ server.")
-        if type.lower() == "external":
-            roles = [
-                ctx.guild.get_role(713538609017258025),
-                ctx.guild.get_role(713538570824187968),
-            ]
-        elif type.lower() == "internal":
-            roles = [ctx.guild.get_role(713538570824187968)]
-        elif type.lower() == "alumni":
-            roles = [ctx.guild.get_role(713538175456247828)]
-        else:
+            return
+        names = MANUAL_ROLES.get(type.lower())
+        if names is None:
             await ctx.send("Type must be internal or external.")
             return
+        roles = filter(None, map(self.settings.roles.get, names))
         await user.add_roles(*roles, reason=f"Manually verified by: {ctx.author}")
-        await self.config.user(user).verified_by.set(ctx.author.name)
-        await self.config.user(user).verified.set(True)
-        await self.config.user(user).email.set(type.title())
+        data = await self.read_user(user)
+        await self.write_user(
+            user, {**data, "verified_by": ctx.author.name, "verified": True, "email": type.title()}
+        )
         await user.send(f"Your account has been verified on CASE++ by {ctx.author}")
         await ctx.tick()
 
@@ -283,33 +799,83 @@ class Verify(commands.Cog):
         """Credential settings"""
         await self.config.username.set(email)
         await self.config.password.set(password)
+        await self.refresh_settings()
+        await self.mailer.reset()
         await ctx.tick()
 
+    async def smtp_credentials(self):
+        return self.settings.username, self.settings.password
+
     async def send_email(self, email, code):
+        """Queue a verification email; it is sent in the background by the mailer."""
         message = EmailMessage()
         message["From"] = "casediscord@gmail.com"
         message["To"] = email
         message["Subject"] = "Discord Verification"
         content = f"Your verification code for the CASE++ server is:\n{code}"
         message.set_content(content)
-        await aiosmtplib.send(
-            message,
-            recipients=[email],
-            hostname="smtp.gmail.com",
-            port=465,
-            username=await self.config.username(),
-            password=await self.config.password(),
-            use_tls=True,
+        self.mailer.enqueue(message)
+
+    @commands.is_owner()
+    @commands.command()
+    async def verifystats(self, ctx):
+        """Show SoC API request latencies, course cache usage and Config calls per command."""
+        calls = "\n".join(
+            f"{name}: {count} call(s) over {self.command_uses[name]} use(s)"
+            for name, count in sorted(self.config_calls.items())
         )
+        text = (
+            f"{self.http.format_latencies()}\nCourse cache: {self.course_cache}\nMail: {self.mailer}\n"
+            f"Last compaction: {self.format_compaction(await self.config.last_compaction())}\n"
+            f"Config calls:\n{calls or 'None yet.'}"
+        )
+        for page in pagify(text):
+            await ctx.send(box(page))
+
+    @staticmethod
+    def format_compaction(stats):
+        if "purged" not in stats:
+            return "never"
+        return (
+            f"{datetime.utcfromtimestamp(stats['at']):%Y-%m-%d %H:%M} UTC, {stats['purged']} purged, "
+            f"{stats['trimmed']} trimmed, at least {stats['bytes']} bytes reclaimed"
+        )
+
+    @commands.is_owner()
+    @commands.command()
+    async def codeexpiry(self, ctx, minutes: int):
+        """Set how many minutes a verification code stays valid."""
+        if minutes < 1:
+            return await ctx.send("Codes must stay valid for at least a minute.")
+        await self.config.code_ttl.set(minutes * 60)
+        await self.refresh_settings()
+        await ctx.tick()
+
+    @commands.is_owner()
+    @commands.command()
+    async def compactusers(self, ctx):
+        """Purge expired codes and abandoned user records now."""
+        async with ctx.typing():
+            stats = await self.compact_users()
+        await ctx.send(f"Compacted user records: {self.format_compaction(stats)}.")
+
+    @commands.command()
+    @commands.admin()
+    async def coursecache(self, ctx, email: str = None):
+        """Invalidate cached course lookups.
+
+        Clears every cached lookup if no email is given."""
+        removed = self.course_cache.invalidate(email.lower() if email else None)
+        self.course_cache.save()
+        await ctx.send(f"Removed {removed} cached course lookup(s).")
 
     @commands.command()
     @commands.admin()
     async def profile(self, ctx, user: discord.Member):
         """Show a users profile information."""
         embed = discord.Embed(color=user.color, title=f"Profile for {user}")
-        useri = await self.config.user(user).verified_by()
-        verif = await self.config.user(user).verified()
-        email = await self.config.user(user).email()
+        data = await self.read_user(user)
+        useri, verif, email = data["verified_by"], data["verified"], data["email"]
         embed.add_field(name="Verified", value=str(verif))
         if not verif:
             await ctx.send(embed=embed)
@@ -346,6 +912,7 @@ class Verify(commands.Cog):
         if pred.result:
             async with self.config.welcome_messages() as messages:
                 messages.append(msgtoadd)
+            await self.refresh_settings()
 
             await ctx.send("Appended greeting message to existing list successfully!")
         else:
@@ -355,7 +922,7 @@ class Verify(commands.Cog):
     @commands.admin()
     async def listmessages(self, ctx):
         """List welcome messages."""
-        msgs = await self.config.welcome_messages()
+        msgs = self.settings.welcome_messages
         if not msgs:
             return await ctx.send("No custom responses available.")
         a = chunks(msgs, 10)
@@ -381,112 +948,141 @@ class Verify(commands.Cog):
             if index + 1 > len(msgs):
                 return await ctx.send("Not a valid ID!")
             msgs.pop(index)
-            await ctx.tick()
+        await self.refresh_settings()
+        await ctx.tick()
 
     @commands.command()
     async def fixroles(self, ctx):
         """Recheck specific roles."""
         async with ctx.typing():
-            rolesa = {
-                "case4": ctx.guild.get_role(713541403904442438),
-                "case3": ctx.guild.get_role(713539660936118282),
-                "case2": ctx.guild.get_role(713538655817564250),
-                "ca": ctx.guild.get_role(713541535085494312),
-                "case": ctx.guild.get_role(713538335984975943),
-            }
-            msg = ""
             user = ctx.message.author
 
-            if not await self.config.user(user).verified():
+            data = await self.read_user(user)
+            if not data["verified"]:
                 return await ctx.send("Unfortunately we do not have your account data on record. Please re-verify or contact an Admin for roles.")
-            email = await self.config.user(user).email()
+            email = data["email"]
 
             user_year = await self.get_course_year(email.lower())
-            roles = []
-
-            if type(user_year) != dict:
-                msg = ""
-            else:
-                if user_year['course'] == "COMSCI1":
-                    roles.append(rolesa["ca"])
-                    roles.append(rolesa["case"])
-                elif user_year['course'] == "COMSCI2":
-                    roles.append(rolesa["case2"])
-                    roles.append(rolesa["case"])
-                elif user_year['course'] == "CASE3":
-                    roles.append(rolesa["case3"])
-                    roles.append(rolesa["case"])
-                elif user_year['course'] == "CASE4":
-                    roles.append(rolesa["case4"])
-                    roles.append(rolesa["case"])
-
-            if roles:
-                removed_roles = [
-                    role
-                    for role in user.roles
-                    if role not in roles and role in rolesa.values()
-                ]
-                await user.remove_roles(*removed_roles)
-                await user.add_roles(*roles, reason="updated")
-                msg += (
-                    f"Updated {user}s roles - New roles: {', '.join([x.name for x in roles])}\n"
-                )
-            if msg:
-                await ctx.send(msg)
-            else:
-                await ctx.send("An error occured while fetching your data. Please contact an Admin.")
+            if type(user_year) != dict or not self.resolver.roles_for(user_year['course']):
+                return await ctx.send("An error occured while fetching your data. Please contact an Admin.")
+            course = user_year['course']
+            await self.sync_course_roles(user, course, reason="updated")
+            await ctx.send(
+                f"Updated {user}s roles - New roles: {self.course_role_names(user.guild, course)}\n"
+            )
 
     @commands.command()
     @commands.admin()
     async def recheckall(self, ctx):
         """Recheck all users roles."""
-        async with ctx.typing():
-            rolesa = {
-                "case4": ctx.guild.get_role(713541403904442438),
-                "case3": ctx.guild.get_role(713539660936118282),
-                "case2": ctx.guild.get_role(713538655817564250),
-                "ca": ctx.guild.get_role(713541535085494312),
-                "case": ctx.guild.get_role(713538335984975943),
-            }
-            msg = ""
-            for user in ctx.guild.members:
-                if not await self.config.user(user).verified():
-                    continue
-                email = await self.config.user(user).email()
-
-                # Check a the SoC API for course
-                user_year = await self.get_course_year(email.lower())
-                roles = []
+        users = await self.config.all_users()
+        members = [
+            member
+            for member in ctx.guild.members
+            if users.get(member.id, {}).get("verified") and users[member.id].get("email")
+        ]
+        progress = {"checked": 0, "failed": 0}
+        updates = []
+        sem = asyncio.Semaphore(RECHECK_CONCURRENCY)
+        edit_sem = asyncio.Semaphore(RECHECK_EDIT_CONCURRENCY)
 
+        async def recheck(member):
+            try:
+                async with sem:
+                    user_year = await self.get_course_year(users[member.id]["email"].lower())
                 if type(user_year) != dict:
-                    msg = ""
-                else:
-                    if user_year['course'] == "COMSCI1":
-                        roles.append(rolesa["ca"])
-                        roles.append(rolesa["case"])
-                    elif user_year['course'] == "COMSCI2":
-                        roles.append(rolesa["case2"])
-                        roles.append(rolesa["case"])
-                    elif user_year['course'] == "CASE3":
-                        roles.append(rolesa["case3"])
-                        roles.append(rolesa["case"])
-                    elif user_year['course'] == "CASE4":
-                        roles.append(rolesa["case4"])
-                        roles.append(rolesa["case"])
-
-                if roles:
-                    removed_roles = [
-                        role
-                        for role in user.roles
-                        if role not in roles and role in rolesa.values()
-                    ]
-                    await user.remove_roles(*removed_roles)
-                    await user.add_roles(*roles, reason="updated")
-                    msg += (
-                        f"Updated {user}s roles - New roles: {', '.join([x.name for x in roles])}\n"
+                    return
+                course = user_year['course']
+                async with edit_sem:
+                    changed = await self.sync_course_roles(member, course, reason="updated")
+                if changed:
+                    updates.append(
+                        f"Updated {member}s roles - New roles: {self.course_role_names(ctx.guild, course)}\n"
                     )
-            if msg:
-                for page in pagify(msg):
-                    await ctx.send(page)
-            else:
-                await ctx.send("No users updated")
+            except Exception:
+                progress["failed"] += 1
+                log.exception("Failed to recheck %s", member)
+            finally:
+                progress["checked"] += 1
+
+        def status():
+            return (
+                f"Rechecked {progress['checked']}/{len(members)} members, "
+                f"{len(updates)} updated, {progress['failed']} failed."
+            )
+
+        async def report():
+            while True:
+                await asyncio.sleep(5)
+                await message.edit(content=status())
+
+        message = await ctx.send(status())
+        reporter = asyncio.ensure_future(report())
+        try:
+            await asyncio.gather(*(recheck(member) for member in members))
+        finally:
+            reporter.cancel()
+        await message.edit(content=status())
+        if updates:
+            for page in pagify("".join(updates)):
+                await ctx.send(page)
+        else:
+            await ctx.send("No users updated")
+
+    @commands.group()
+    @commands.admin()
+    async def reconcile(self, ctx):
+        """Background course role reconciliation settings."""
+
+    @reconcile.command(name="slice")
+    async def reconcile_slice_size(self, ctx, lookups: int):
+        """Set how many SoC API lookups a slice may make."""
+        if lookups < 1:
+            return await ctx.send("A slice must make at least one lookup.")
+        await self.config.reconcile_slice.set(lookups)
+        await ctx.tick()
+
+    @reconcile.command(name="edits")
+    async def reconcile_edits(self, ctx, edits: int):
+        """Set how many role edits a slice may make."""
+        if edits < 0:
+            return await ctx.send("The edit budget can't be negative.")
+        await self.config.reconcile_edits.set(edits)
+        await ctx.tick()
+
+    @reconcile.command(name="interval")
+    async def reconcile_interval(self, ctx, minutes: int):
+        """Set how many minutes to wait between slices."""
+        if minutes < 1:
+            return await ctx.send("The interval must be at least a minute.")
+        await self.config.reconcile_interval.set(minutes * 60)
+        self._reconcile_task.cancel()
+        self._reconcile_task = self.bot.loop.create_task(self.reconcile_loop())
+        await ctx.tick()
+
+    @reconcile.command(name="run")
+    async def reconcile_run(self, ctx):
+        """Run a scheduled slice now."""
+        async with ctx.typing():
+            checked, edited = await self.reconcile_slice()
+        await ctx.send(f"Checked {checked} member(s), updated {edited}.")
+
+    @reconcile.command(name="status")
+    async def reconcile_status(self, ctx):
+        """Show reconciliation budgets and progress through the current pass."""
+        settings = await self.config.all()
+        cursor = settings["reconcile_cursor"]
+        interval = settings["reconcile_interval"]
+        eligible = cursor.get("eligible", 0)
+        slices = -(-eligible // settings["reconcile_slice"])
+        last_run = cursor.get("last_run")
+        last_run = f"{datetime.utcfromtimestamp(last_run):%Y-%m-%d %H:%M} UTC" if last_run else "never"
+        text = (
+            f"Slice: {settings['reconcile_slice']} lookup(s), {settings['reconcile_edits']} edit(s) "
+            f"every {interval // 60} minute(s)\n"
+            f"Pass: {cursor.get('sweep_checked', 0)}/{eligible} checked, "
+            f"{cursor.get('sweeps', 0)} completed, ~{slices * interval / 3600:.1f}h per pass\n"
+            f"Last slice: {last_run}\n"
+            f"Queued by events: {len(self.reconcile_pending)}, deferred: {len(self.reconcile_deferred)}"
+        )
+        await ctx.send(box(text))